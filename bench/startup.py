@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+'''
+Measures the latency of short flow commands, such as `flow --version` and `flow -n`,
+so that regressions in flow's own startup time show up between versions.
+
+Usage: python bench/startup.py [-n RUNS] [--flow COMMAND] > startup.json
+
+By default it runs the flow in this source tree with the current python.
+'''
+import json
+import optparse
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+_src = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+COMMANDS = [
+    ('version', ['--version']),
+    ('dryrun', ['-n']),
+    ('dryrun-quiet', ['-nq']),
+    ('task-dryrun', ['-n', '-t', 'model']),
+    ('flows', ['--flows']),
+]
+
+def _time(cmd, cwd, env, runs):
+    '''returns the wall times in milliseconds of `runs` executions of `cmd`'''
+    devnull = open(os.devnull, 'w')
+    try:
+        times = list()
+        for i in xrange(runs):
+            start = time.time()
+            subprocess.check_call(cmd, cwd=cwd, env=env, stdout=devnull, stderr=devnull)
+            times.append((time.time() - start) * 1000.0)
+        return times
+    finally:
+        devnull.close()
+
+def main(args = sys.argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', metavar='RUNS', type='int', dest='runs', default=20,
+                      help='number of runs per command (default: 20)')
+    parser.add_option('--flow', metavar='COMMAND', dest='flow', default=None,
+                      help='flow command to measure, e.g. "flow" (default: this source tree)')
+    (options, args) = parser.parse_args(args)
+
+    env = dict(os.environ)
+    if options.flow is None:
+        flow = [sys.executable, '-m', 'flow.shell']
+        env['PYTHONPATH'] = os.path.abspath(_src)
+    else:
+        flow = options.flow.split()
+
+    # a directory with one scriptie for each stage of the default style
+    tmpdir = tempfile.mkdtemp(prefix='flow-bench-')
+    try:
+        for stage in ('setup', 'import', 'model', 'export'):
+            open(os.path.join(tmpdir, '%s.sh' % (stage)), 'w').write('exit 0\n')
+            open(os.path.join(tmpdir, '%s1.sh' % (stage)), 'w').write('exit 0\n')
+
+        _time(flow + ['--version'], tmpdir, env, 2) # warm up the filesystem caches
+        results = dict()
+        for (name, argv) in COMMANDS:
+            times = sorted(_time(flow + argv, tmpdir, env, options.runs))
+            results[name] = { 'runs': options.runs,
+                              'min_ms': round(times[0], 2),
+                              'median_ms': round(times[len(times) / 2], 2),
+                              'mean_ms': round(sum(times) / len(times), 2) }
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print json.dumps({ 'benchmark': 'startup', 'command': ' '.join(flow), 'results': results }, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+'''
+Measures flow's own overhead on synthetic workflow trees: discovery of the directories, resolution of
+the scripties in each one, dispatch of a scriptie, and whole `flow -r` runs, so that regressions in
+flow's scheduling costs show up between versions.
+
+Usage: python bench/trees.py [-n RUNS] [--trees 10x2,10x3,36x3] [--flow COMMAND] > trees.json
+
+Each tree is WIDTHxDEPTH: every directory down to DEPTH has WIDTH subdirectories, so 36x3 is about
+48k directories. Every directory gets an `sh` scriptie for each of --stages, --numbered passes of
+each stage, and --files other files. Runs that would start more than --max-scripties scripties are
+only measured as dry runs.
+'''
+import json
+import optparse
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+_src = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+def _make_tree(root, width, depth, stages, numbered, files, sleep):
+    '''writes the tree, returning its number of directories and of scripties'''
+    body = 'sleep %s\n' % (sleep) if sleep > 0 else 'exit 0\n'
+    (ndirs, nscripties) = (0, 0)
+    level = ['']
+    for d in xrange(depth + 1):
+        for rel in level:
+            dirp = os.path.join(root, rel)
+            if not os.path.isdir(dirp):
+                os.mkdir(dirp)
+            ndirs += 1
+            for stage in stages:
+                for name in ['%s.sh' % (stage)] + ['%s%d.sh' % (stage, i) for i in xrange(1, numbered + 1)]:
+                    open(os.path.join(dirp, name), 'w').write(body)
+                    nscripties += 1
+            for i in xrange(files):
+                open(os.path.join(dirp, '_data%d.csv' % (i)), 'w').close()
+        if d < depth:
+            level = [os.path.join(rel, 'd%d' % (i)) for rel in level for i in xrange(width)]
+    return (ndirs, nscripties)
+
+def _stats(times):
+    times = sorted(times)
+    return { 'runs': len(times),
+             'min_ms': round(times[0] * 1000.0, 2),
+             'median_ms': round(times[len(times) / 2] * 1000.0, 2) }
+
+def _time(f, runs):
+    '''returns the wall times in seconds of `runs` calls of `f`'''
+    times = list()
+    for i in xrange(runs):
+        start = time.time()
+        f()
+        times.append(time.time() - start)
+    return times
+
+def _bench_inprocess(flow, root, stages, runs, dispatches):
+    f = flow.Flow(root, quiet=True, numbered=True, excluded_dirs=[], excluded_prefix=['.', '_'])
+    results = dict()
+    results['discovery_iter_dirs'] = _stats(_time(lambda: f._iter_dirs(root), runs))
+    results['discovery_bylevel_iter'] = _stats(_time(lambda: f._bylevel_iter(root), runs))
+
+    dirs = [root] + [os.path.join(root, p) for p in f._iter_dirs(root)]
+    def resolve():
+        for d in dirs:
+            g = f.spawn(d)
+            listings = dict()
+            for stage in stages:
+                g._find_scripties(stage, listings)
+    results['resolution'] = _stats(_time(resolve, runs))
+    results['resolution']['per_dir_us'] = round(results['resolution']['median_ms'] * 1000.0 / len(dirs), 2)
+
+    runner = flow.FlowExecution(quiet=True)
+    sample = [(d, '%s.sh' % (stages[0])) for d in dirs[0:dispatches]]
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    saved = os.dup(1)
+    os.dup2(devnull, 1) # the scripties' output
+    try:
+        times = _time(lambda: [runner.run(fn, cwd=d) for (d, fn) in sample], runs)
+    finally:
+        os.dup2(saved, 1)
+        os.close(saved)
+        os.close(devnull)
+    results['dispatch'] = _stats(times)
+    results['dispatch']['per_scriptie_ms'] = round(results['dispatch']['median_ms'] / len(sample), 3)
+    return results
+
+def _bench_shell(cmd, root, env, runs, argvs):
+    devnull = open(os.devnull, 'w')
+    try:
+        results = dict()
+        for (name, argv) in argvs:
+            results[name] = _stats(_time(lambda: subprocess.check_call(cmd + argv, cwd=root, env=env,
+                                                                        stdout=devnull, stderr=devnull), runs))
+        return results
+    finally:
+        devnull.close()
+
+def main(args = sys.argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('-n', metavar='RUNS', type='int', dest='runs', default=3,
+                      help='number of runs per measurement (default: 3)')
+    parser.add_option('--trees', metavar='WxD,...', dest='trees', default='10x2,10x3',
+                      help='trees to measure, each WIDTHxDEPTH (default: 10x2,10x3; 36x3 is about 48k directories)')
+    parser.add_option('--stages', metavar='STAGES', dest='stages', default='setup,import,model,export',
+                      help='stages with a scriptie in every directory (default: setup,import,model,export)')
+    parser.add_option('--numbered', metavar='N', type='int', dest='numbered', default=0,
+                      help='numbered passes of every stage in every directory (default: 0)')
+    parser.add_option('--files', metavar='N', type='int', dest='files', default=2,
+                      help='other files in every directory (default: 2)')
+    parser.add_option('--sleep', metavar='SECONDS', type='float', dest='sleep', default=0,
+                      help='how long each scriptie sleeps, or 0 to exit immediately (default: 0)')
+    parser.add_option('--dispatches', metavar='N', type='int', dest='dispatches', default=100,
+                      help='scripties to dispatch through FlowExecution.run per run (default: 100)')
+    parser.add_option('--max-scripties', metavar='N', type='int', dest='max_scripties', default=5000,
+                      help='only measure dry runs of trees with more scripties than N (default: 5000)')
+    parser.add_option('--jobs', metavar='N', type='int', dest='jobs', default=4,
+                      help='concurrent jobs for the flow -rj runs (default: 4)')
+    parser.add_option('--flow', metavar='COMMAND', dest='flow', default=None,
+                      help='flow command to measure end to end, e.g. "flow" (default: this source tree)')
+    (options, args) = parser.parse_args(args)
+
+    sys.path.insert(0, os.path.abspath(_src))
+    import flow
+
+    env = dict(os.environ)
+    if options.flow is None:
+        cmd = [sys.executable, '-m', 'flow.shell']
+        env['PYTHONPATH'] = os.path.abspath(_src)
+    else:
+        cmd = options.flow.split()
+    stages = [s for s in options.stages.split(',') if s != '']
+    env['FLOW_STYLE_DEFAULT'] = ','.join(stages)
+    os.environ['FLOW_STYLE_DEFAULT'] = env['FLOW_STYLE_DEFAULT']
+
+    results = list()
+    for tree in options.trees.split(','):
+        (width, depth) = [int(i) for i in tree.split('x')]
+        tmpdir = tempfile.mkdtemp(prefix='flow-bench-')
+        try:
+            start = time.time()
+            (ndirs, nscripties) = _make_tree(tmpdir, width, depth, stages, options.numbered, options.files, options.sleep)
+            r = { 'tree': tree, 'dirs': ndirs, 'scripties': nscripties, 'generate_s': round(time.time() - start, 2) }
+            r.update(_bench_inprocess(flow, tmpdir, stages, options.runs, options.dispatches))
+            argvs = [('flow-rn', ['-rn']), ('flow-rnq', ['-rnq'])]
+            if nscripties <= options.max_scripties:
+                argvs += [('flow-r', ['-r']), ('flow-rj', ['-r', '-j', str(options.jobs)])]
+            r.update(_bench_shell(cmd, tmpdir, env, options.runs, argvs))
+            results.append(r)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    print json.dumps({ 'benchmark': 'trees', 'command': ' '.join(cmd), 'python': sys.version.split()[0],
+                       'options': { 'stages': stages, 'numbered': options.numbered, 'files': options.files,
+                                    'sleep': options.sleep, 'jobs': options.jobs },
+                       'results': results }, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,4 @@
+# flow-outputs: _data.csv
 import csv
 from random import random
 print 'Generating some dummy data in data.csv...'
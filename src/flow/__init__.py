@@ -36,15 +36,55 @@ Usage
       -n, --dryrun     do not actually execute any scripties (default: No)
       -k, --keep-going Keep going when scripties exit with error (default: Yes)
       -K, --not-keep-going
-                       Turns off -k (default: No).
+                       Turns off -k, and stops every running scriptie at the
+                       first error (default: No).
       -N, --nonumbers  suppress running numbered files (default: No)
-      -j               flow with up to 16 concurrent jobs (default: 1)
+      -j [N], --jobs[=N]
+                       flow with up to N concurrent jobs, or 16 with no N
+      -l LOAD, --load-average=LOAD
+                       start no new work while the load average is at least LOAD
+      --mem-free=MB    start no new work while less than MB of memory is available
+      --weight=STAGE=N scripties of STAGE take N of the -j job slots
+      --threads=[STAGE=]N
+                       let scripties (of STAGE) start N threads each, rather
+                       than the CPUs divided by -j
+      --pin            with -j, pin each scriptie to CPUs of its own
       -i               flow with interactive confirmations (default: No)
       -d dir           directory in which to run (default: .)
       --style=STYLE    flow with style (default: 'standard')
       --task=TASK      flow with task (default: None)
       --exclude=NAME   exclude from running within folder named NAME
+      --executor=NAME  run concurrent flows in 'thread' or 'process' workers, or
+                       on other hosts over 'ssh'
+      --hosts=HOSTS    with --executor ssh, run flows on HOSTS, e.g. node1:8,node2:16
+      --max-procs=N    run at most N scriptie processes at once across all flows
+      --stage-jobs=N   run up to N numbered passes at once in stages marked '&'
+      --sql-batch=SCOPE
+                       run the SQL scripties of each stage or style in one session
+      --warm-python    run python scripties in pre-started workers
+      --cache=DIR      restore the declared outputs of unchanged scripties from DIR
+      --scratch=DIR    run each directory flow in a copy in DIR, and copy new and
+                       changed files back when it succeeds
+      --logs           capture scriptie output in per-stage log files in _logs
+      --report=FILE    record time and resources used by each scriptie in FILE
+      --report-top=N   with --report, summarize the N slowest scripties
+      --profile=FILE   analyze the critical path and parallel efficiency of the
+                       run, and write its timeline to FILE in Chrome trace format
+      --history        start the flows expected to take longest first, from the
+                       times of past runs, and estimate the time left
+      --journal=FILE   record each flow and scriptie as it starts and finishes
+      --resume         skip the work that the journal records as finished
+      --plan=FILE      write what the flow would run to FILE, without running it
+      --execute=FILE   run the plan in FILE without listing any directories
+      --check-plan     with --execute, refuse to run a plan that is out of date
+      --watch          after running, run again wherever files change
+      --daemon=SOCKET  serve flow commands on the Unix socket SOCKET
       --flows          print list of flow styles and languages supported
+      --index          with -r, only list directories that changed since last time
+      --incremental    skip scripties unchanged since their last successful run
+      --force          with --incremental, run every scriptie anyway
+      --invalidate=STAGE
+                       with --incremental, run STAGE again and every later stage
 
 =============
 Example Usage
@@ -103,16 +143,130 @@ Override the style::
 
     % env FLOW_STYLE_SIMPLE="setup,finish" flow -s simple
     
+Run the numbered passes of the download stage concurrently (e.g., download1.sh
+through download40.sh, 8 at a time) before moving on to the next stage::
+
+    % env FLOW_STYLE_DEFAULT="setup,download&,import,model" flow --stage-jobs 8
+
+Run up to 32 scripties at once across 16 directories, but at most 4 psql
+and 16 R processes::
+
+    % env FLOW_PROC_LIMITS="psql=4,R=16" flow -rj --max-procs 32
+
+Find the slowest scripties and stages, keeping every measurement in
+report.csv (or JSON lines, for any other filename)::
+
+    % flow -rj --report report.csv
+
+See whether -j helped, and open trace.json in chrome://tracing to see where
+workers sat idle::
+
+    % flow -rj --profile trace.json
+
+Keep a flow daemon running, so that frequent flow commands skip startup (the
+command still runs from your directory and environment)::
+
+    % flow --daemon /tmp/flow.sock &
+    % env FLOW_DAEMON=/tmp/flow.sock flow -t doit
+
+Keep each stage's output in _logs/STAGE.stdout.log and _logs/STAGE.stderr.log,
+capped at 1 MB with 5 compressed backups, while the console shows every line
+prefixed with its directory and stage::
+
+    % env FLOW_LOG_MAXBYTES=1048576 FLOW_LOG_BACKUPS=5 FLOW_LOG_COMPRESS=1 flow -rj --logs
+
+Run all SQL scripties of the db style (e.g., create1.sql through load200.sql)
+over one database connection, or try it out against SQLite first::
+
+    % flow -s db --sql-batch style
+    % env SQL_SHELL=sqlite3 SQL_FLAGS=test.db flow -s db --sql-batch style
+
+Run many small python scripties in warm workers that have already imported
+numpy and pandas, rather than starting a new python for each one::
+
+    % env FLOW_PYTHON_PRELOAD="numpy,pandas" flow -rj --warm-python
+
+Reuse the outputs of scripties that declare them, across directories and
+runs, e.g. "# flow-inputs: _data.csv" and "# flow-outputs: _results.txt" in
+model.R (use "--" in SQL and "%" in LaTeX), keeping at most 10 GB in the cache::
+
+    % env FLOW_CACHE_MAXBYTES=10737418240 flow -rj --cache ~/.flowcache
+
+Spread the directory flows over two nodes that share the tree's filesystem,
+with up to 8 and 16 flows at once, and retry flows elsewhere if a node fails
+(the top directory still runs here; use local:N to include this machine)::
+
+    % flow -r --executor ssh --hosts node1:8,node2:16
+
+Keep a journal of a long run, and if it is interrupted (or the node reboots),
+pick up where it left off, running only the scripties that did not finish
+successfully (interrupting a flow also stops the scripties it started)::
+
+    % flow -rj --journal .flowjournal
+    % flow -rj --resume
+
+Remember how long each directory flow took in .flowhistory, so that later runs
+start the flows with the longest expected work ahead of them first, rather than
+in alphabetical order, and report about how much time is left as they go::
+
+    % flow -rj --history
+
+Resolve the directories, scripties and command lines of a large tree once, on
+a login node, and then run that plan as often as needed on compute nodes that
+share the filesystem, without listing any directories (--check-plan refuses
+to run it if scripties or subdirectories were added or removed since)::
+
+    % flow -r --plan /shared/model.plan
+    % flow -j 16 --execute /shared/model.plan --check-plan
+
+Run 8 flows at once on a 32-CPU node, letting the R and python scripties of
+each start 4 OpenMP and BLAS threads (with -j, flow sets OMP_NUM_THREADS,
+OPENBLAS_NUM_THREADS, MKL_NUM_THREADS and the like to the CPUs divided by -j
+unless they are set already), but give model scripties 16 threads, and so 4 of
+the 8 job slots, and pin every scriptie to CPUs of its own::
+
+    % flow -rj 8 --threads model=16 --pin
+
+Run each directory flow in a copy of its files in /dev/shm rather than on NFS,
+copying 16 files at once (FLOW_SCRATCH_JOBS), and copy back only the files
+that are new or changed once its stages succeed; subdirectories and excluded names
+(_* and .* by default) are symlinked, and with FLOW_SCRATCH_KEEP=failed the
+copies of failed flows stay in /dev/shm for inspection::
+
+    % env FLOW_SCRATCH_JOBS=16 FLOW_SCRATCH_KEEP=failed flow -rj --scratch /dev/shm
+
+Run the tree, then keep watching it while you edit: each time files change
+(once they stop changing for FLOW_WATCH_DEBOUNCE seconds), run only the flows
+of the directories they are in, and of those directories' parents, deepest
+first (changes that the scripties themselves make are ignored)::
+
+    % flow -r --watch --incremental
+
+Run 8 jobs at once, but start no new flows or scripties while the load average
+is 6 or more, or less than 4 GB of memory is available, and count each model
+scriptie as 4 of the 8 jobs::
+
+    % flow -rj 8 -l 6 --mem-free 4096 --weight model=4
+
 Use a single task flow::
 
     % flow -t doit
 
+Only run scripties that changed since their last successful run (state is
+kept in .flowstate in each directory)::
+
+    % flow -r --incremental
+
+Run the model stage again, and every stage after it::
+
+    % flow --incremental --invalidate model
+
 '''
 __svnid__ = '$Id: __init__.py 5895 2013-01-16 01:14:33Z hardy $'
 __author__ = "Darren Hardy <hardy@nceas.ucsb.edu>"
 __version__ = '0.9.3 (r%d)' % (int(__svnid__.split()[2])) 
 __credits__ = "New BSD Licence"
 
-from flow import Flow
+from flow import Flow, FlowAdmission, FlowCPUs, FlowExecution, ThrottledFlowExecution, registry, terminate_children
 
-__all__ = [ 'Flow' ]
+__all__ = [ 'Flow', 'FlowAdmission', 'FlowCPUs', 'FlowExecution', 'ThrottledFlowExecution', 'registry', 'terminate_children' ]
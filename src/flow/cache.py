@@ -0,0 +1,180 @@
+'''
+A content-addressed cache of scriptie outputs, shared across directories and runs
+'''
+import hashlib
+import json
+import os
+import os.path
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from flow import _sha1
+
+# e.g., "# flow-outputs: _results.txt" in R, python or shell, "-- flow-inputs: ..." in SQL, "% ..." in LaTeX
+_header = re.compile(r'^\s*(?:#|--|%|//)\s*flow-(inputs|outputs):(.*)$')
+_maxlines = 50 # declarations must appear within the first lines of a scriptie
+
+def declarations(fn):
+    '''returns (inputs, outputs) declared in the header comments of scriptie `fn`, e.g.
+        # flow-inputs: _data.csv
+        # flow-outputs: _results.txt model.Rout
+    Filenames are separated by spaces or commas, and relative to the scriptie's directory.'''
+    io = { 'inputs': [], 'outputs': [] }
+    f = open(fn)
+    try:
+        for (i, line) in enumerate(f):
+            if i >= _maxlines:
+                break
+            m = _header.match(line)
+            if m is not None:
+                io[m.group(1)].extend([s for s in re.split(r'[\s,]+', m.group(2)) if s != ''])
+    finally:
+        f.close()
+    return (io['inputs'], io['outputs'])
+
+def _copy(src, dst):
+    '''copies `src` onto `dst` atomically, so concurrent flows never see a partial file'''
+    tmpfn = '%s.%d-%d.tmp' % (dst, os.getpid(), threading.current_thread().ident)
+    try:
+        shutil.copyfile(src, tmpfn)
+        os.rename(tmpfn, dst)
+    except:
+        _unlink(tmpfn)
+        raise
+
+def _unlink(fn):
+    try:
+        os.unlink(fn)
+    except OSError, e: # already evicted by a concurrent flow
+        pass
+
+class FlowCache(object):
+    '''A cache directory of scriptie outputs keyed by the scriptie's content, command line and declared inputs.
+    Output files are kept once each by content in objects/, and each cached run is an entries/KEY.json
+    that names them. The least recently used entries are evicted once the objects exceed `maxbytes`.
+    Supports the FLOW_CACHE_DIR and FLOW_CACHE_MAXBYTES (default 1073741824) environment variables.'''
+    def __init__(self, cachedir = None, maxbytes = None):
+        super(FlowCache, self).__init__()
+        self._dir = os.path.abspath(cachedir if cachedir is not None else os.getenv('FLOW_CACHE_DIR'))
+        self._maxbytes = maxbytes if maxbytes is not None else int(os.getenv('FLOW_CACHE_MAXBYTES', '1073741824'))
+        for d in ('objects', 'entries'):
+            if not os.path.isdir(os.path.join(self._dir, d)):
+                os.makedirs(os.path.join(self._dir, d))
+        self._init_lock()
+
+    def _init_lock(self):
+        self._lock = threading.Lock() # serializes eviction within a process
+
+    def __getstate__(self):
+        d = dict(self.__dict__)
+        del d['_lock']
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._init_lock()
+
+    def key(self, cmdarray, cwd = None):
+        '''returns the cache key for running `cmdarray` in `cwd`, or None if its scriptie declares no
+        outputs or any of its inputs is missing'''
+        cwd = cwd or '.'
+        fn = os.path.join(cwd, cmdarray[-1])
+        (inputs, outputs) = declarations(fn)
+        if len(outputs) == 0:
+            return None
+        h = hashlib.sha1()
+        h.update(json.dumps({ 'cmd': cmdarray, 'outputs': outputs }, sort_keys=True))
+        h.update(_sha1(fn))
+        for name in inputs:
+            p = os.path.join(cwd, name)
+            if not os.path.isfile(p):
+                return None
+            h.update('\0%s\0%s' % (name, _sha1(p)))
+        return h.hexdigest()
+
+    def _entry(self, key):
+        return os.path.join(self._dir, 'entries', '%s.json' % (key))
+
+    def _object(self, sha1):
+        return os.path.join(self._dir, 'objects', sha1[0:2], sha1[2:])
+
+    def restore(self, key, cwd = None):
+        '''copies the outputs cached under `key` into `cwd`, returning False on a miss'''
+        try:
+            e = json.load(open(self._entry(key)))
+            now = time.time()
+            for (name, sha1) in sorted(e['outputs'].items()):
+                dst = os.path.join(cwd or '.', name)
+                if not os.path.isdir(os.path.dirname(dst) or '.'):
+                    os.makedirs(os.path.dirname(dst))
+                _copy(self._object(sha1), dst)
+                os.utime(self._object(sha1), (now, now))
+            os.utime(self._entry(key), (now, now)) # most recently used
+            return True
+        except (IOError, OSError, ValueError), e: # missing, evicted meanwhile, or unreadable
+            return False
+
+    def store(self, key, cwd, scriptie):
+        '''caches the outputs that `scriptie` declares in `cwd` under `key`, returning False if any is missing'''
+        (inputs, outputs) = declarations(os.path.join(cwd or '.', scriptie))
+        e = { 'scriptie': scriptie, 'outputs': dict() }
+        for name in outputs:
+            p = os.path.join(cwd or '.', name)
+            if not os.path.isfile(p):
+                return False
+            sha1 = _sha1(p)
+            obj = self._object(sha1)
+            if not os.path.isfile(obj):
+                if not os.path.isdir(os.path.dirname(obj)):
+                    try:
+                        os.makedirs(os.path.dirname(obj))
+                    except OSError, err: # made by a concurrent store
+                        pass
+                _copy(p, obj)
+            e['outputs'][name] = sha1
+        (fd, tmpfn) = tempfile.mkstemp(prefix='.tmp-', dir=os.path.join(self._dir, 'entries'))
+        f = os.fdopen(fd, 'w')
+        try:
+            json.dump(e, f, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(tmpfn, self._entry(key))
+        self.evict()
+        return True
+
+    def evict(self):
+        '''removes the least recently used entries until their objects fit in `maxbytes`, then any unused objects'''
+        with self._lock:
+            entries = list()
+            for name in os.listdir(os.path.join(self._dir, 'entries')):
+                if name.endswith('.json'):
+                    p = os.path.join(self._dir, 'entries', name)
+                    try:
+                        entries.append((os.stat(p).st_mtime, p, json.load(open(p))['outputs'].values()))
+                    except (IOError, OSError, ValueError), e:
+                        pass
+            sizes = dict()
+            for (mtime, p, objs) in entries:
+                for sha1 in objs:
+                    if sha1 not in sizes and os.path.isfile(self._object(sha1)):
+                        sizes[sha1] = os.path.getsize(self._object(sha1))
+
+            entries.sort(reverse=True) # newest first
+            kept = set()
+            total = 0
+            for (mtime, p, objs) in entries:
+                size = sum([sizes.get(sha1, 0) for sha1 in set(objs) - kept])
+                if total + size > self._maxbytes and total > 0:
+                    _unlink(p)
+                else:
+                    kept.update(objs)
+                    total += size
+
+            objdir = os.path.join(self._dir, 'objects')
+            for d in os.listdir(objdir):
+                for name in os.listdir(os.path.join(objdir, d)):
+                    if d + name not in kept and not name.endswith('.tmp'):
+                        _unlink(os.path.join(objdir, d, name))
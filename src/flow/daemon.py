@@ -0,0 +1,165 @@
+'''
+A long-lived flow server on a local Unix socket, so that repeated flow commands skip interpreter startup
+'''
+import errno
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import sys
+import traceback
+
+def _send(sock, channel, data):
+    '''sends one frame: a channel byte ('1' stdout, '2' stderr or 'x' exit status), a length and the data'''
+    sock.sendall(struct.pack('!cI', channel, len(data)) + data)
+
+def _recv(sock, n):
+    '''returns exactly `n` bytes from `sock`, or None if it closes first'''
+    data = ''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if chunk == '':
+            return None
+        data += chunk
+    return data
+
+def _run(request, main):
+    '''runs `main(argv)` for `request` as if from the client's directory and environment, returning its exit status'''
+    os.chdir(request['cwd'])
+    os.environ.clear()
+    os.environ.update(request['env'])
+    os.environ.pop('FLOW_DAEMON', None) # never forward back to ourselves
+    try:
+        main(request['argv'])
+        return 0
+    except SystemExit, e:
+        if e.code is None:
+            return 0
+        if isinstance(e.code, int):
+            return e.code & 0xff
+        print >>sys.stderr, e.code
+        return 1
+    except Exception, e:
+        traceback.print_exc()
+        return 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+def _handle(conn, main):
+    '''runs one request from `conn` in a child process, relaying its stdout and stderr back as frames'''
+    f = conn.makefile('rb')
+    request = json.loads(f.readline())
+    f.close()
+
+    (outr, outw) = os.pipe()
+    (errr, errw) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.setpgid(0, 0) # so that stopping it reaches the workers it starts too
+        conn.close()
+        os.close(outr)
+        os.close(errr)
+        os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+        os.dup2(outw, 1)
+        os.dup2(errw, 2)
+        os._exit(_run(request, main))
+    try:
+        os.setpgid(pid, pid) # as well, so the group exists before it could be stopped
+    except OSError, e: # the child got there first
+        pass
+    os.close(outw)
+    os.close(errw)
+
+    channels = { outr: '1', errr: '2' }
+    try:
+        while len(channels) > 0:
+            for fd in select.select(channels.keys() + [conn], [], [])[0]: # the client too, which sends nothing more
+                if fd is conn:
+                    if conn.recv(4096) == '':
+                        raise socket.error(errno.EPIPE, 'the client disconnected')
+                    continue
+                data = os.read(fd, 65536)
+                if data == '':
+                    os.close(fd)
+                    del channels[fd]
+                else:
+                    _send(conn, channels[fd], data)
+    except socket.error, e: # the client went away, so stop its flow, even a quiet one
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except OSError, e:
+            pass
+        for fd in channels: # so that it cannot block writing to them while it stops
+            os.close(fd)
+    status = os.waitpid(pid, 0)[1]
+    try:
+        _send(conn, 'x', str(-os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)))
+    except socket.error, e:
+        pass
+    conn.close()
+
+def serve(path, main):
+    '''Accepts flow commands on the Unix socket `path` until interrupted.
+    Each command runs `main(argv)` in a child forked from this already-initialized process.'''
+    if os.path.exists(path):
+        os.unlink(path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    prev = os.umask(0077) # only our user may connect
+    try:
+        server.bind(path)
+    finally:
+        os.umask(prev)
+    server.listen(64)
+    print >>sys.stderr, 'flow daemon listening on %s' % (path)
+    try:
+        while True:
+            try:
+                (conn, addr) = server.accept()
+            except socket.error, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            pid = os.fork()
+            if pid == 0:
+                server.close()
+                try:
+                    _handle(conn, main)
+                finally:
+                    os._exit(0)
+            conn.close()
+            try:
+                while os.waitpid(-1, os.WNOHANG)[0] != 0: # reap finished handlers
+                    pass
+            except OSError, e:
+                pass
+    finally:
+        server.close()
+        os.unlink(path)
+
+def request(path, argv):
+    '''Runs the flow command `argv` on the server listening at `path`, relaying its output to ours.
+    Returns its exit status, or None if no server is listening.'''
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error, e:
+        sock.close()
+        return None
+    try:
+        sock.sendall(json.dumps({ 'argv': argv, 'cwd': os.getcwd(), 'env': dict(os.environ) }) + '\n')
+        while True:
+            header = _recv(sock, 5)
+            if header is None:
+                return 1 # the server went away
+            (channel, n) = struct.unpack('!cI', header)
+            data = _recv(sock, n)
+            if channel == 'x':
+                return int(data)
+            out = sys.stdout if channel == '1' else sys.stderr
+            out.write(data)
+            out.flush()
+    finally:
+        sock.close()
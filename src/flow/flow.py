@@ -2,21 +2,163 @@
 A Swiss-army knife for scientific workflows using linear process model
 '''
 from collections import deque
-from glob import glob
+from contextlib import contextmanager
+import ctypes
+import errno
+import hashlib
+import json
 import multiprocessing as mp
+from multiprocessing.pool import ThreadPool
 import os
 import os.path
+import pickle
+import Queue
 import re
+import signal
 import subprocess
 import sys
+import threading
+import time
 
-def _pool_run_one(flow): 
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir # optional backport, see https://pypi.python.org/pypi/scandir
+    except ImportError:
+        scandir = None
+
+_prototype = None # the Flow that each process worker spawns its flows from
+
+_children = set()                 # process groups of the running scripties, for terminate_children()
+_children_lock = threading.Lock()
+_cancelled = threading.Event()    # set by the first failure without keep_going, so no more scripties start
+_cancel_cause = None              # the directory of that failure
+_cpus_lock = threading.Lock()     # for FlowCPUs to take its share in each process worker
+
+def _pool_init(prototype):
+    global _prototype
+    _prototype = prototype
+    _pool_signals(False)
+
+def _pool_signals(running):
+    '''The parent's signals reach the workers, but not their scripties, which a running worker terminates.
+    An idle worker ignores SIGINT and dies of SIGTERM right away, since python 2 defers signal handlers
+    while it waits for a task, and so Pool.terminate() would wait for it forever.'''
+    stop = lambda signum, frame: (terminate_children(), os._exit(1))
+    signal.signal(signal.SIGINT, stop if running else signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stop if running else signal.SIG_DFL)
+
+def _pool_run_one(task): 
     '''this must be a static, pickle-able function for mp.Pool to work correctly'''
-    flow.run(0, 1)
+    _pool_signals(True)
+    try:
+        (key, e) = _run_task(_prototype, task)
+    finally:
+        _pool_signals(False)
+    try:
+        pickle.loads(pickle.dumps(e))
+    except Exception, ignored: # e.g., python 2's CalledProcessError, which would stop the pool from returning results
+        e = RuntimeError(str(e))
+    return (key, e)
+
+def _run_task(prototype, task):
+    '''Runs the (rootdir, style, key) `task` in a flow spawned from `prototype`.
+    Returns `key` along with any exception raised, so the scheduler always hears back.'''
+    (rootdir, style, key) = task
+    if _cancelled.is_set(): # queued before an earlier failure, so it never journals or stages anything
+        return (key, RuntimeError('Cancelled the flow for %s after an earlier failure' % (rootdir)))
+    try:
+        prototype.spawn(rootdir).run(0, 1, style)
+    except Exception, e:
+        return (key, e)
+    return (key, None)
+
+def _setpgid(pin = None):
+    '''puts a child in its own process group, so terminate_children() reaches everything it starts,
+    and pins it to its CPUs with `pin` from _setaffinity(), if given'''
+    os.setpgid(0, 0)
+    if pin is not None:
+        pin()
+
+def _register(pid, running = True):
+    with _children_lock:
+        if running:
+            _children.add(pid)
+        else:
+            _children.discard(pid)
+
+def _alive(pid):
+    try:
+        f = open('/proc/%d/stat' % (pid))
+        try:
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z' # a zombie is only waiting to be reaped
+        finally:
+            f.close()
+    except IOError, e:
+        pass
+    try:
+        os.kill(pid, 0)
+        return True
+    except OSError, e:
+        return False
+
+def terminate_children(grace = None):
+    '''Sends SIGTERM to the process group of every running scriptie, and SIGKILL once they have had `grace` seconds
+    to exit. Supports the FLOW_KILL_GRACE environment variable (default 5).'''
+    if grace is None:
+        grace = float(os.getenv('FLOW_KILL_GRACE', '5'))
+    with _children_lock:
+        pgids = list(_children)
+    for (sig, wait) in ((signal.SIGTERM, grace), (signal.SIGKILL, 0)):
+        for pgid in pgids:
+            try:
+                os.killpg(pgid, sig)
+            except OSError, e: # already gone
+                pass
+        deadline = time.time() + wait
+        while time.time() < deadline and any([_alive(pgid) for pgid in pgids]):
+            time.sleep(0.1)
+
+def _cancel(cause = None):
+    '''Fails fast after a failure in the directory `cause`: stops scripties from starting in this process, 
+    and terminates those running'''
+    global _cancel_cause
+    if not _cancelled.is_set():
+        _cancel_cause = cause
+        _cancelled.set()
+        terminate_children()
+
+def _worker():
+    '''identifies the process and thread doing the work, for reports'''
+    return '%d/%s' % (os.getpid(), threading.current_thread().name)
 
 def _ingest_from_env(var, default, delim=','):
     return [s.strip() for s in os.getenv(var, default).split(delim)]
 
+def _sha1(fn):
+    h = hashlib.sha1()
+    f = open(fn, 'rb')
+    try:
+        for chunk in iter(lambda: f.read(65536), ''):
+            h.update(chunk)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+def _index_passes(names):
+    '''returns {prefix: {number: [filenames in listing order]}} for every way that a filename 
+    splits into a prefix and a pass number, e.g., "model12.sh" is both ("model", 12) and ("model1", 2)'''
+    bypass = dict()
+    for name in names:
+        stem = os.path.splitext(name)[0]
+        k = len(stem)
+        while k > 0 and stem[k-1].isdigit():
+            k -= 1
+        for i in xrange(k, len(stem)):
+            bypass.setdefault(stem[0:i], {}).setdefault(int(stem[i:]), []).append(name)
+    return bypass
+
 def _match_prefixes(s, prefixes):
     for p in prefixes:
         if p.endswith('*') and not p.endswith('\*'):
@@ -29,7 +171,9 @@ def _match_prefixes(s, prefixes):
 
 class FlowLanguages(list):
     '''data type for iterating languages'''
-    def __init__(self, langs = _ingest_from_env('FLOW_LANGUAGES', 'sh,py,pl,rb,R,r,sql,tex')):
+    def __init__(self, langs = None):
+        if langs is None:
+            langs = _ingest_from_env('FLOW_LANGUAGES', 'sh,py,pl,rb,R,r,sql,tex')
         super(FlowLanguages, self).__init__(langs)
 
 class FlowStyle(list):
@@ -42,7 +186,11 @@ class FlowStyle(list):
         return self
 
 class FlowStyles(dict):
-    def __init__(self):
+    def __init__(self, styles = None):
+        '''@param styles FlowStyles to copy, rather than reading them from the environment'''
+        if styles is not None:
+            super(FlowStyles, self).__init__(styles)
+            return
         super(FlowStyles, self).__init__({
             'default':  FlowStyle().from_env('FLOW_STYLE_DEFAULT',  
                                              'setup,download,import,ingest,model,run,digest,export,report,upload,finish'),
@@ -60,14 +208,133 @@ class FlowStyles(dict):
                                              'setup,test,report')
         })
 
+_registries = dict() # (FlowStyles, FlowLanguages) by the environment variables they were read from
+
+def registry():
+    '''Returns the (FlowStyles, FlowLanguages) for the FLOW_STYLE_* and FLOW_LANGUAGES environment variables.
+    These are read only once per process for each distinct setting, and shared by every Flow that does not
+    get its own, so treat them as read-only.'''
+    key = tuple(sorted([(k, v) for (k, v) in os.environ.items() if k.startswith('FLOW_STYLE_') or k == 'FLOW_LANGUAGES']))
+    if key not in _registries:
+        _registries[key] = (FlowStyles(), FlowLanguages())
+    return _registries[key]
+
+class FlowState(dict):
+    '''data type for remembering how each scriptie last ran, for incremental flows'''
+    def __init__(self, dirp = '.', force = False):
+        '''@param dirp directory whose scripties are tracked in its .flowstate file
+        @param force treats every scriptie as out-of-date
+        '''
+        super(FlowState, self).__init__()
+        self._dirp = dirp
+        self._fn = os.path.join(dirp, '.flowstate')
+        self._dirty = force
+        fn = self._fn
+        if os.path.isfile(fn):
+            try:
+                self.update(json.load(open(fn)))
+            except ValueError, e:
+                pass # an unreadable state file just means everything runs again
+
+    def invalidate(self):
+        '''Marks this scriptie and every scriptie after it as out-of-date'''
+        self._dirty = True
+
+    def uptodate(self, fn, cmdarray):
+        '''True if `fn` last exited successfully with the same content and command line'''
+        if self._dirty or fn not in self:
+            return False
+        s = self[fn]
+        return s['status'] == 0 and s['cmd'] == cmdarray and s['sha1'] == _sha1(os.path.join(self._dirp, fn))
+
+    def record(self, fn, cmdarray, status):
+        self._dirty = True
+        self[fn] = { 'sha1': _sha1(os.path.join(self._dirp, fn)), 'cmd': cmdarray, 'status': status }
+
+    def save(self):
+        tmpfn = '%s.tmp' % (self._fn)
+        f = open(tmpfn, 'w')
+        try:
+            json.dump(self, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(tmpfn, self._fn)
+
+class FlowIndex(dict):
+    '''data type for caching directory listings between recursive flows. 
+    Maps each directory relative to the root onto its mtime, subdirectories and scriptie filenames,
+    so that unchanged directories are not listed again.'''
+    def __init__(self, root, key):
+        '''@param root top directory whose .flowindex file holds the cache
+        @param key anything that changes which entries are listed (e.g., exclusions and languages)
+        '''
+        super(FlowIndex, self).__init__()
+        self._root = os.path.abspath(root)
+        self._fn = os.path.join(root, '.flowindex')
+        self._key = key
+        if os.path.isfile(self._fn):
+            try:
+                d = json.load(open(self._fn))
+                if d.get('key') == key:
+                    self.update(d['dirs'])
+            except ValueError, e:
+                pass # an unreadable index just means everything is listed again
+        self._seen = set()
+
+    def listdir(self, dirp, rel, lister):
+        '''returns (subdirectories, scripties) of `dirp`, calling `lister(dirp)` only if its mtime changed'''
+        self._seen.add(rel)
+        mtime = os.stat(dirp).st_mtime
+        e = self.get(rel)
+        if e is not None and e['mtime'] == mtime:
+            return (e['dirs'], e['files'])
+        (dirs, files) = lister(dirp)
+        if time.time() - mtime > 2.0: # changes within the same mtime tick would go unnoticed
+            self[rel] = { 'mtime': mtime, 'dirs': dirs, 'files': files }
+        elif rel in self:
+            del self[rel]
+        return (dirs, files)
+
+    def files(self, dirp):
+        '''returns the scripties of `dirp` as last listed, or None if it was not listed or changed since'''
+        rel = os.path.relpath(os.path.abspath(dirp), self._root)
+        e = self.get('' if rel == '.' else rel)
+        if e is None or e['mtime'] != os.stat(dirp).st_mtime:
+            return None
+        return [fn.encode('utf-8') if isinstance(fn, unicode) else fn for fn in e['files']] # as listed, not as decoded
+
+    def save(self):
+        '''Rewrites the index in place rather than renaming a new one over it, which would change the mtime of the root, 
+        and so list it again every time. An index cut short by a crash is unreadable, and so just ignored.'''
+        for rel in [rel for rel in self if rel not in self._seen]: # forget removed directories
+            del self[rel]
+        f = open(self._fn, 'w')
+        try:
+            json.dump({ 'key': self._key, 'dirs': self }, f, sort_keys=True)
+        finally:
+            f.close()
+
 class FlowExecution(object):
     """docstring for FlowExecution"""
-    def __init__(self, dryrun = False, quiet = False, interactive = False, keep_going = True):
+    def __init__(self, dryrun = False, quiet = False, interactive = False, keep_going = True, report = None, logs = None, cache = None, warm = None, journal = None, cpus = None):
+        '''@param report a FlowReport that receives the timing and resource usage of every scriptie
+        @param logs a FlowLogs that captures the stdout and stderr of every scriptie into per-stage log files
+        @param cache a FlowCache from which to restore the declared outputs of scripties instead of running them
+        @param warm a FlowWarmPython whose workers run python scripties, unless their output goes to `logs`
+        @param journal a FlowJournal that records each scriptie as it starts and finishes, and skips those already done
+        @param cpus a FlowCPUs that sets how many threads each child process may start, and where it runs
+        '''
         super(FlowExecution, self).__init__()
         self._dryrun = dryrun
         self._quiet = quiet
         self._interactive = interactive
         self._keep_going = keep_going
+        self._report = report
+        self._logs = logs
+        self._cache = cache
+        self._warm = warm
+        self._journal = journal
+        self._cpus = cpus
         self._m = {
             'pl':   'run_perl',
             'rb':   'run_ruby',
@@ -78,7 +345,7 @@ class FlowExecution(object):
         '''Resolve an extension or key into method name for the run method'''
         return self._m[ext] if ext in self._m else 'run_%s' % (ext)
 
-    def run(self, fn, ext = None):
+    def run(self, fn, ext = None, argv = None, **kw):
         '''Main execution interface. 
         Runs the script in `fn` using the `ext` to determine how to execute the script. 
         If `ext` is None, then uses `os.path.splitext` to determine extensions. 
@@ -86,6 +353,9 @@ class FlowExecution(object):
         
         @param fn script filename
         @param ext how to execute the file
+        @param argv command line that runs `fn`, e.g., from a FlowPlan, instead of the one for `ext`
+        @param kw passed through to the run method (e.g., `cwd` in which to run, `dirp` under which the journal and report
+        record it if not `cwd`, or `state` for incremental flows)
         '''
 
         if ext is None:
@@ -99,42 +369,49 @@ class FlowExecution(object):
             else:
                 ok = True
             
+            if ok and argv is not None and kw.get('session') is None:
+                return self._execcmd(argv, **kw)
             if ok:
-                return getattr(self, k)(fn)
+                return getattr(self, k)(fn, **kw)
         else:
             raise NotImplemented('Unknown script extention: %s' % (ext))
 
-    def run_perl(self, fn):
+    def run_perl(self, fn, **kw):
         '''Runs a perl script. Supports PERL environment variable (default is 'perl'). @param fn script filename'''
-        return self._execcmd([os.getenv("PERL", 'perl'), fn])
+        return self._execcmd([os.getenv("PERL", 'perl'), fn], **kw)
 
-    def run_ruby(self, fn):
+    def run_ruby(self, fn, **kw):
         '''Runs a ruby script. Supports RUBY environment variable (default is 'ruby'). @param fn script filename'''
-        return self._execcmd([os.getenv("RUBY", 'ruby'), fn])
+        return self._execcmd([os.getenv("RUBY", 'ruby'), fn], **kw)
 
-    def run_sh(self, fn):
+    def run_sh(self, fn, **kw):
         '''Runs a shell script. Supports the SHELL environment variable to choose a shell (default is 'sh'). @param fn script filename'''
-        return self._execcmd([os.getenv("SHELL", 'sh'), fn])
+        return self._execcmd([os.getenv("SHELL", 'sh'), fn], **kw)
 
-    def run_python(self, fn):
+    def run_python(self, fn, **kw):
         '''Runs a python script. Supports PYTHON environment variable (default is 'python'). @param fn script filename'''
-        return self._execcmd([os.getenv('PYTHON', 'python'), fn])
+        return self._execcmd([os.getenv('PYTHON', 'python'), fn], **kw)
 
-    def run_r(self, fn):
+    def run_r(self, fn, **kw):
         '''Runs an R script in non-interactive batch mode, or if R_FLAGS is set it uses regular mode and inserts the flags provided. @param fn script filename'''
         flags = os.getenv("R_FLAGS", None)
         if (flags is None):
-            return self._execcmd(['R', 'CMD', 'BATCH', '--no-save', '--no-restore', fn]) # side-effect of fn.Rout as log
+            return self._execcmd(['R', 'CMD', 'BATCH', '--no-save', '--no-restore', fn], **kw) # side-effect of fn.Rout as log
         
         l = ['R']
         for flag in flags.split(' '):
             l.append(flag)
         l.append('-f')
         l.append(fn)
-        return self._execcmd(l)
+        return self._execcmd(l, **kw)
 
-    def run_sql(self, fn):
-        '''Runs an SQL script. Supports the SQL_SHELL environment variable to choose an SQL interpreter (default is 'psql'), and the SQL_FLAGS environment variable to pass extra flags (default is '-w'). @param fn script filename'''
+    def run_sql(self, fn, session = None, **kw):
+        '''Runs an SQL script. Supports the SQL_SHELL environment variable to choose an SQL interpreter (default is 'psql'), and the SQL_FLAGS environment variable to pass extra flags (default is '-w'). 
+        @param fn script filename
+        @param session a FlowSQLSession from sql_session() in which to run the script, instead of its own interpreter
+        '''
+        if session is not None:
+            return self._execbatch(session, fn, **kw)
         l = [os.getenv("SQL_SHELL", 'psql')]
         for flag in os.getenv("SQL_FLAGS", "-w").split(' '):
             l.append(flag)
@@ -142,47 +419,548 @@ class FlowExecution(object):
             l.append('--quiet')
         l.append('-f')
         l.append(fn)
-        return self._execcmd(l)
+        return self._execcmd(l, **kw)
 
-    def run_tex(self, fn):
+    def sql_session(self, cwd = None):
+        '''returns a FlowSQLSession in `cwd` for SQL_SHELL and SQL_FLAGS, which starts its interpreter on first use'''
+        shell = os.getenv("SQL_SHELL", 'psql')
+        dialect = 'sqlite' if os.path.basename(shell).startswith('sqlite') else 'psql'
+        l = [shell] + _sql_dialects[dialect]['flags']
+        for flag in os.getenv("SQL_FLAGS", "-w" if dialect == 'psql' else '').split(' '):
+            if flag != '':
+                l.append(flag)
+        if self._quiet and dialect == 'psql':
+            l.append('--quiet')
+        return FlowSQLSession(l, cwd, dialect)
+
+    def run_tex(self, fn, **kw):
         '''Runs an LaTeX script. Default flags are '-silent'. Supports LATEX_SHELL which defaults to latexmk. @param fn script filename'''
-        return self._execcmd([os.getenv("LATEX_SHELL", 'latexmk'), '-silent', fn])             
+        return self._execcmd([os.getenv("LATEX_SHELL", 'latexmk'), '-silent', fn], **kw)             
+
+    def _execcmd(self, cmdarray, inputfn = '/dev/null', outputfn = '-', logfn = '-', state = None, cwd = None, stage = None, npass = None, dirp = None):
+        dirp = dirp if dirp is not None else cwd # the package, which the scripties may run in a scratch copy of
+        if _cancelled.is_set():
+            raise RuntimeError('Cancelled %s script %s after an earlier failure' % (os.path.basename(cmdarray[0]), cmdarray[-1]))
+        if state is not None and state.uptodate(cmdarray[-1], cmdarray):
+            self._logger('Skipping up-to-date %s script %s' % (os.path.basename(cmdarray[0]), cmdarray[-1]))
+            return 0
+        if self._journal is not None and self._journal.done(dirp, cmdarray[-1]):
+            self._logger('Skipping finished %s script %s' % (os.path.basename(cmdarray[0]), cmdarray[-1]))
+            return 0
+
+        key = None
+        if self._cache is not None and not self._dryrun:
+            key = self._cache.key(cmdarray, cwd)
+            if key is not None and self._cache.restore(key, cwd):
+                self._logger('Restored cached outputs of %s script %s' % (os.path.basename(cmdarray[0]), cmdarray[-1]))
+                if state is not None:
+                    state.record(cmdarray[-1], cmdarray, 0)
+                if self._journal is not None:
+                    self._journal.finished(dirp, cmdarray[-1], 0)
+                return 0
 
-    def _execcmd(self, cmdarray, inputfn = '/dev/null', outputfn = '-', logfn = '-'):
         self._logger('Running %s script %s' % (os.path.basename(cmdarray[0]), cmdarray[-1]))
 
         if self._dryrun:
+            if state is not None: # later scripties would run too
+                state.invalidate()
             if self._quiet: # print out scriptie name only (in quiet mode)
                 print >>sys.stdout, cmdarray[-1] # scriptie name assumed to be last
             return
 
+        if self._journal is not None:
+            self._journal.started(dirp, cmdarray[-1])
+
+        opened = list()
         if inputfn is None or inputfn == '-':
             inf = sys.stdin
         else:
             inf = open(inputfn, 'rb')
+            opened.append(inf)
 
+        relay = None
         if outputfn is None or outputfn == '-':
             outf = sys.stdout
         else:
             outf = open(outputfn, 'wb')
+            opened.append(outf)
 
         if logfn is None or logfn == '-':
             logf = sys.stderr
         else:
             logf = open(logfn, 'ab')
+            opened.append(logf)
+
+        if self._logs is not None and outf is sys.stdout and logf is sys.stderr:
+            relay = self._logs.relay(cwd, stage, cmdarray[-1])
+            (outf, logf) = (subprocess.PIPE, subprocess.PIPE)
 
+        env = self._cpus.environ(stage) if self._cpus is not None else None
         try:
-            return subprocess.check_call(cmdarray, stdin=inf, stdout=outf, stderr=logf)
-        except subprocess.CalledProcessError, e:
-            self._logger('ERROR: Running %s script %s exited with non-zero status code %d' % (os.path.basename(cmdarray[0]), cmdarray[-1], e.returncode))
+            with self._slot(cmdarray, stage):
+                start = time.time()
+                if relay is None and self._warm is not None and self._warm.handles(cmdarray, inputfn):
+                    (status, usage) = self._warm.call(cmdarray, inputfn, outputfn, logfn, cwd, env)
+                elif self._cpus is not None:
+                    with self._cpus.pinned(stage) as cpus:
+                        (status, usage) = self._call(cmdarray, inf, outf, logf, cwd, relay, env, cpus)
+                else:
+                    (status, usage) = self._call(cmdarray, inf, outf, logf, cwd, relay)
+                wall = time.time() - start
+        finally:
+            for f in opened:
+                f.close()
+
+        if self._report is not None:
+            self._report.append({ 'kind': 'scriptie', 'dir': os.path.abspath(dirp or '.'), 'stage': stage, 'pass': npass, 'scriptie': cmdarray[-1], 
+                                  'interpreter': os.path.basename(cmdarray[0]), 'status': status, 
+                                  'start': round(start, 3), 'wall': round(wall, 3), 
+                                  'utime': round(usage.ru_utime, 3), 'stime': round(usage.ru_stime, 3),
+                                  'maxrss_kb': usage.ru_maxrss / 1024 if sys.platform == 'darwin' else usage.ru_maxrss,
+                                  'worker': _worker() })
+        if state is not None:
+            state.record(cmdarray[-1], cmdarray, status)
+        if self._journal is not None:
+            self._journal.finished(dirp, cmdarray[-1], status)
+        if key is not None and status == 0 and not self._cache.store(key, cwd, cmdarray[-1]):
+            self._logger('WARNING: %s script %s did not write all of its declared outputs' % (os.path.basename(cmdarray[0]), cmdarray[-1]))
+        if status != 0:
+            self._logger('ERROR: Running %s script %s exited with non-zero status code %d' % (os.path.basename(cmdarray[0]), cmdarray[-1], status))
             if not self._keep_going:
-                raise e
+                _cancel(os.path.abspath(dirp or '.'))
+                raise subprocess.CalledProcessError(status, cmdarray)
+        return status
+
+    def _execbatch(self, session, fn, state = None, cwd = None, stage = None, npass = None, dirp = None, **kw):
+        '''Runs the SQL script `fn` in `session`, with the same skipping, reporting and error handling as _execcmd'''
+        dirp = dirp if dirp is not None else cwd
+        cmdarray = session.command() + [fn]
+        if _cancelled.is_set():
+            raise RuntimeError('Cancelled %s script %s after an earlier failure' % (os.path.basename(cmdarray[0]), fn))
+        if state is not None and state.uptodate(fn, cmdarray):
+            self._logger('Skipping up-to-date %s script %s' % (os.path.basename(cmdarray[0]), fn))
+            return 0
+        if self._journal is not None and self._journal.done(dirp, fn):
+            self._logger('Skipping finished %s script %s' % (os.path.basename(cmdarray[0]), fn))
+            return 0
+
+        self._logger('Running %s script %s in session' % (os.path.basename(cmdarray[0]), fn))
+        if self._journal is not None:
+            self._journal.started(dirp, fn)
+        with self._slot(cmdarray, stage):
+            start = time.time()
+            status = session.run(fn)
+            wall = time.time() - start
+
+        if self._report is not None: # the interpreter's resource usage is not attributable to one script
+            self._report.append({ 'kind': 'scriptie', 'dir': os.path.abspath(dirp or '.'), 'stage': stage, 'pass': npass, 'scriptie': fn, 
+                                  'interpreter': os.path.basename(cmdarray[0]), 'status': status, 
+                                  'start': round(start, 3), 'wall': round(wall, 3), 
+                                  'utime': 0.0, 'stime': 0.0, 'maxrss_kb': 0, 'worker': _worker() })
+        if state is not None:
+            state.record(fn, cmdarray, status)
+        if self._journal is not None:
+            self._journal.finished(dirp, fn, status)
+        if status != 0:
+            self._logger('ERROR: Running %s script %s exited with non-zero status code %d' % (os.path.basename(cmdarray[0]), fn, status))
+            if not self._keep_going:
+                _cancel(os.path.abspath(dirp or '.'))
+                raise subprocess.CalledProcessError(status, cmdarray)
+        return status
+
+    def _call(self, cmdarray, stdin, stdout, stderr, cwd, relay = None, env = None, cpus = None):
+        '''Runs `cmdarray` to completion, returning its exit status (negative for a signal) and its resource usage.
+        @param relay a FlowLogRelay that drains the child's stdout and stderr pipes
+        @param env environment of the child (default: this process's)
+        @param cpus list of CPUs to pin the child to (default: any)
+        '''
+        p = None
+        pin = _setaffinity(cpus) if cpus is not None else None
+        try:
+            p = subprocess.Popen(cmdarray, stdin=stdin, stdout=stdout, stderr=stderr, cwd=cwd, env=env, 
+                                 preexec_fn=lambda: _setpgid(pin))
+            _register(p.pid)
+            if _cancelled.is_set(): # cancelled while it started, after terminate_children() looked
+                os.killpg(p.pid, signal.SIGTERM)
+            if relay is not None:
+                relay.start(p.stdout, p.stderr)
+            while True:
+                try:
+                    (pid, status, usage) = os.wait4(p.pid, 0)
+                    break
+                except OSError, e:
+                    if e.errno != errno.EINTR:
+                        raise
+        finally:
+            if p is not None:
+                _register(p.pid, False)
+            if relay is not None:
+                relay.join()
+        p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        return (p.returncode, usage)
+
+    @contextmanager
+    def _slot(self, cmdarray, stage = None):
+        '''Held while the child process for `cmdarray` runs'''
+        yield
 
-        
     def _logger(self, s):
         if not self._quiet:
             print >>sys.stderr, s
 
+_sql_dialects = {
+    # include a script, echo a line, and flags that stop at the first error
+    'psql':   { 'include': "\\i '%s'",   'echo': '\\echo %s', 'flags': ['-v', 'ON_ERROR_STOP=1'] },
+    'sqlite': { 'include': ".read '%s'", 'echo': '.print %s',  'flags': ['-bail'] }
+}
+
+class FlowSQLSession(object):
+    '''One SQL interpreter that is fed scripts over stdin, so that many scripts share one database connection.
+    Each script is included and then followed by an echoed marker. The interpreter stops at the first error, so a
+    script succeeded if and only if its marker comes back; a failed script ends the session, and the next script
+    starts a new one. Supports SQL_BATCH_INCLUDE and SQL_BATCH_ECHO to override the commands (e.g., "\\i '%s'").'''
+    def __init__(self, cmdarray, cwd = None, dialect = 'psql'):
+        super(FlowSQLSession, self).__init__()
+        self._cmdarray = cmdarray
+        self._cwd = cwd
+        self._include = os.getenv('SQL_BATCH_INCLUDE', _sql_dialects[dialect]['include'])
+        self._echo = os.getenv('SQL_BATCH_ECHO', _sql_dialects[dialect]['echo'])
+        self._marker = 'flow-%s' % (hashlib.sha1('%s %s' % (os.getpid(), time.time())).hexdigest()[0:12])
+        self._p = None
+        self._n = 0
+
+    def command(self):
+        return list(self._cmdarray)
+
+    def run(self, fn):
+        '''runs the script `fn` in this session, returning 0 on success or the interpreter's exit status'''
+        if self._p is None:
+            self._p = subprocess.Popen(self._cmdarray, stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=self._cwd, preexec_fn=_setpgid)
+            _register(self._p.pid)
+        self._n += 1
+        marker = '%s-%d' % (self._marker, self._n)
+        try:
+            self._p.stdin.write('%s\n%s\n' % (self._include % (fn), self._echo % (marker)))
+            self._p.stdin.flush()
+        except IOError, e: # the interpreter already exited
+            pass
+        for line in iter(self._p.stdout.readline, ''):
+            text = line.rstrip('\r\n')
+            if text.endswith(marker): # after the script's last line of output, if that did not end with a newline
+                sys.stdout.write(text[0:len(text) - len(marker)])
+                return 0
+            sys.stdout.write(line)
+        status = self.close()
+        return status if status != 0 else 1
+
+    def close(self):
+        '''ends the interpreter, returning its exit status'''
+        if self._p is None:
+            return 0
+        (p, self._p) = (self._p, None)
+        try:
+            p.stdin.close()
+        except IOError, e:
+            pass
+        for line in iter(p.stdout.readline, ''):
+            sys.stdout.write(line)
+        try:
+            return p.wait()
+        finally:
+            _register(p.pid, False)
+
+def _meminfo(fn = '/proc/meminfo'):
+    '''returns the available memory in MB, or None where it cannot be read'''
+    try:
+        f = open(fn)
+        try:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / 1024
+        finally:
+            f.close()
+    except IOError, e:
+        pass
+    return None
+
+class FlowAdmission(object):
+    '''Admission control for a run: a pool of job slots, of which each scriptie takes its stage's weight 
+    (default 1), and which admits no new work while the load average or available memory crosses a threshold.
+    Like make's -l, work is always admitted when nothing else is running, so the run cannot stall.'''
+    def __init__(self, slots, load = None, memfree = None, weights = None, interval = 1.0):
+        '''@param slots number of job slots
+        @param load maximum 1-minute load average at which to start new work (default: no limit)
+        @param memfree minimum available memory in MB at which to start new work (default: no limit)
+        @param weights dict of stage name to the number of slots its scripties take (e.g., {'model': 4})
+        @param interval seconds between checks of the load and memory while work is held back
+        '''
+        super(FlowAdmission, self).__init__()
+        self._slots = max(slots, 1)
+        self._load = load
+        self._memfree = memfree
+        self._weights = weights if weights is not None else dict()
+        self._interval = interval
+        self._init_lock()
+
+    def _init_lock(self):
+        self._cond = threading.Condition()
+        self._used = 0
+
+    def __getstate__(self):
+        '''locks cannot be pickled, so each process executor gets its own slots'''
+        d = dict(self.__dict__)
+        del d['_cond']
+        del d['_used']
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._init_lock()
+
+    def weight(self, stage):
+        return min(self._weights.get(stage, 1), self._slots)
+
+    def ok(self):
+        '''returns whether the node has room for new work by load average and available memory'''
+        if self._load is not None and os.getloadavg()[0] >= self._load:
+            return False
+        if self._memfree is not None:
+            avail = _meminfo()
+            if avail is not None and avail < self._memfree:
+                return False
+        return True
+
+    def acquire(self, weight = 1):
+        with self._cond:
+            while self._used > 0 and (self._used + weight > self._slots or not self.ok()):
+                self._cond.wait(self._interval) # with a timeout, to notice when the load drops
+            self._used += weight
+
+    def release(self, weight = 1):
+        with self._cond:
+            self._used -= weight
+            self._cond.notify_all()
+
+def _affinity():
+    '''returns the CPUs this process may run on'''
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    try:
+        mask = (ctypes.c_ulong * 16)() # 1024 CPUs
+        if ctypes.CDLL(None, use_errno=True).sched_getaffinity(0, ctypes.sizeof(mask), mask) == 0:
+            bits = ctypes.sizeof(ctypes.c_ulong) * 8
+            return [i for i in xrange(len(mask) * bits) if mask[i / bits] & (1 << (i % bits))]
+    except (AttributeError, OSError), e: # not Linux
+        pass
+    return range(mp.cpu_count())
+
+_sched_setaffinity = None # libc's, once resolved
+
+def _setaffinity(cpus):
+    '''returns a function that pins the process calling it to `cpus`, e.g., a child before it runs a scriptie.
+    The library function and its arguments are resolved here in the parent, as a child forked from a threaded
+    parent can deadlock loading a library before it execs.'''
+    global _sched_setaffinity
+    if hasattr(os, 'sched_setaffinity'):
+        cpus = set(cpus)
+        return lambda: os.sched_setaffinity(0, cpus)
+    if _sched_setaffinity is None:
+        _sched_setaffinity = ctypes.CDLL(None, use_errno=True).sched_setaffinity
+    mask = (ctypes.c_ulong * 16)()
+    bits = ctypes.sizeof(ctypes.c_ulong) * 8
+    for i in cpus:
+        mask[i / bits] |= 1 << (i % bits)
+    (f, size) = (_sched_setaffinity, ctypes.sizeof(mask))
+    return lambda: f(0, size, mask)
+
+# the variables that cap the threads of OpenMP and of the BLAS, LAPACK and numexpr libraries in R and python
+_thread_variables = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+class FlowCPUs(object):
+    '''Splits the CPUs among the scripties of concurrent directory flows, so that multithreaded scripties
+    do not each start a thread per CPU: each child process gets OMP_NUM_THREADS, OPENBLAS_NUM_THREADS and 
+    the like set to its share, unless they are already set, and can be pinned to that many CPUs of its own.
+    A stage that gets more threads should take more admission slots too, as weights() suggests.'''
+    def __init__(self, slots, threads = None, pin = False):
+        '''@param slots number of directory flows at once, among which the CPUs are split
+        @param threads dict of stage name, or None for every other stage, to the number of threads its scripties get
+        (default: the CPUs divided by `slots`)
+        @param pin pins each child process to as many otherwise unused CPUs as it has threads, where there are enough
+        '''
+        super(FlowCPUs, self).__init__()
+        self._cpus = _affinity()
+        self._threads = dict(threads) if threads is not None else dict()
+        self._threads.setdefault(None, max(len(self._cpus) / max(slots, 1), 1))
+        self._slots = slots
+        self._pin = pin
+        self._init_lock()
+
+    def _init_lock(self):
+        self._lock = threading.Lock()
+        self._identity = mp.current_process()._identity # of the process whose CPUs _free holds
+        self._free = self._share()
+
+    def _share(self):
+        '''returns the CPUs this process pins within: all of them, or a share of its own in a process executor's worker'''
+        identity = mp.current_process()._identity
+        if len(identity) == 0:
+            return list(self._cpus)
+        share = max(len(self._cpus) / max(self._slots, 1), 1)
+        i = (identity[0] - 1) % max(self._slots, 1) * share
+        return self._cpus[i:i + share] or list(self._cpus)
+
+    def __getstate__(self):
+        '''locks cannot be pickled, so each process executor pins within its own CPUs'''
+        d = dict(self.__dict__)
+        del d['_lock']
+        del d['_free']
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._init_lock()
+
+    def threads(self, stage = None):
+        return self._threads.get(stage, self._threads[None])
+
+    def weights(self):
+        '''returns the dict of stage name to the admission slots its scripties take, by their share of threads'''
+        return dict([(stage, max(int(round(float(n) / self._threads[None])), 1)) for (stage, n) in self._threads.items() 
+                     if stage is not None])
+
+    def environ(self, stage = None):
+        '''returns the environment for a child process in `stage`'''
+        env = dict(os.environ)
+        for k in _thread_variables:
+            if k not in os.environ:
+                env[k] = str(self.threads(stage))
+        return env
+
+    @contextmanager
+    def pinned(self, stage = None):
+        '''Held while a child process in `stage` runs, yielding the CPUs it should be pinned to, or None'''
+        cpus = None
+        if self._pin:
+            identity = mp.current_process()._identity
+            if self._identity != identity: # a forked worker, for which Pool did not pickle this, so _free is the parent's
+                with _cpus_lock:
+                    if self._identity != identity:
+                        (self._lock, self._free, self._identity) = (threading.Lock(), self._share(), identity)
+            with self._lock:
+                n = self.threads(stage)
+                if len(self._free) >= n:
+                    (cpus, self._free) = (self._free[0:n], self._free[n:])
+        try:
+            yield cpus
+        finally:
+            if cpus is not None:
+                with self._lock:
+                    self._free = sorted(self._free + cpus)
+
+class ThrottledFlowExecution(FlowExecution):
+    '''FlowExecution that caps how many child processes run at once, both in total and per interpreter.
+    The caps are shared by every thread using this object, so they span all directories and stages
+    of a flow run with the thread executor.'''
+    def __init__(self, dryrun = False, quiet = False, interactive = False, keep_going = True, report = None, logs = None, maxprocs = None, limits = None, admission = None, cache = None, warm = None, journal = None, cpus = None):
+        '''@param maxprocs maximum number of running child processes (default: no limit)
+        @param limits dict of interpreter name to its maximum number of running child processes. 
+        Supports the FLOW_PROC_LIMITS environment variable (e.g., "psql=4,R=16").
+        @param admission a FlowAdmission whose slots each child process takes by the weight of its stage
+        '''
+        super(ThrottledFlowExecution, self).__init__(dryrun, quiet, interactive, keep_going, report, logs, cache, warm, journal, cpus)
+        self._maxprocs = maxprocs
+        self._admission = admission
+        if limits is None:
+            limits = dict([(k.strip(), int(v)) for (k, v) in 
+                           [i.split('=', 1) for i in _ingest_from_env('FLOW_PROC_LIMITS', '') if i != '']])
+        self._limits = limits
+        self._init_semaphores()
+
+    def _init_semaphores(self):
+        self._all = threading.BoundedSemaphore(self._maxprocs) if self._maxprocs is not None else None
+        self._each = dict([(k, threading.BoundedSemaphore(v)) for (k, v) in self._limits.items()])
+
+    def __getstate__(self):
+        '''semaphores cannot be pickled, so each process executor gets its own'''
+        d = dict(self.__dict__)
+        del d['_all']
+        del d['_each']
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._init_semaphores()
+
+    @contextmanager
+    def _slot(self, cmdarray, stage = None):
+        # wait on the interpreter limit first, so a queued psql does not hold one of the global slots
+        each = self._each.get(os.path.basename(cmdarray[0]))
+        if each is not None:
+            each.acquire()
+        try:
+            weight = self._admission.weight(stage) if self._admission is not None else 0
+            if self._admission is not None:
+                self._admission.acquire(weight)
+            try:
+                if self._all is not None:
+                    self._all.acquire()
+                try:
+                    yield
+                finally:
+                    if self._all is not None:
+                        self._all.release()
+            finally:
+                if self._admission is not None:
+                    self._admission.release(weight)
+        finally:
+            if each is not None:
+                each.release()
+
+
+class FlowPool(object):
+    '''A pool of workers for directory flows, which is started once and can be reused by any number of runs
+    until it is closed. Each flow is sent to a worker as a small (rootdir, style) task, and spawned there 
+    from the prototype Flow that the worker received when it started.
+    Flow.run accepts any pool with the same nproc(), submit(), close() and terminate() methods, such as FlowSSHPool.'''
+    def __init__(self, prototype, nproc, executor = 'thread'):
+        '''@param prototype the Flow whose settings, styles and runner every flow in the pool uses
+        @param nproc number of workers
+        @param executor pool of 'thread' or 'process' workers
+        '''
+        super(FlowPool, self).__init__()
+        self._nproc = nproc
+        if executor == 'process':
+            self._pool = mp.Pool(nproc, _pool_init, (prototype,))
+            self._func = _pool_run_one
+        else:
+            self._pool = ThreadPool(nproc)
+            self._func = lambda task: _run_task(prototype, task)
+
+    def nproc(self):
+        return self._nproc
+
+    def submit(self, rootdir, style, key, callback):
+        '''Runs the flow for `rootdir` with `style`, then calls `callback((key, exception or None))`'''
+        self._pool.apply_async(self._func, ((rootdir, style, key),), callback=callback)
+
+    def close(self):
+        '''Waits for all submitted flows to finish and shuts the workers down'''
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None: # e.g., interrupted, so the queued flows must not run
+            self.terminate()
+        else:
+            self.close()
+
 
 class Flow(object):
     '''Flow is the main base class for executing flows'''
@@ -198,9 +976,45 @@ class Flow(object):
                  languages = None,
                  runner = None,
                  keep_going = True,
+                 report = None,
+                 logs = None,
+                 cache = None,
+                 warm = None,
+                 journal = None,
+                 cpus = None,
                  excluded_dirs = [],
-                 excluded_prefix = []):
-        '''@param numbered supports numbered scripties (e.g., export01.sh, export02.sh, etc.)'''
+                 excluded_prefix = [],
+                 incremental = False,
+                 force = False,
+                 invalidated = [],
+                 stage_jobs = None,
+                 executor = 'thread',
+                 index = False,
+                 admission = None,
+                 sql_batch = None,
+                 history = None,
+                 plan = None,
+                 scratch = None):
+        '''@param numbered supports numbered scripties (e.g., export01.sh, export02.sh, etc.)
+        @param report a FlowReport that receives the timing of every directory flow, and of every scriptie unless `runner` is given
+        @param logs a FlowLogs that captures scriptie output into per-stage log files (unless `runner` is given)
+        @param cache a FlowCache that restores the declared outputs of unchanged scripties (unless `runner` is given)
+        @param warm a FlowWarmPython that runs python scripties in warm workers (unless `runner` is given)
+        @param journal a FlowJournal that records each directory flow as it starts and finishes, and skips those already done
+        @param cpus a FlowCPUs that splits the CPUs among the scripties of concurrent flows (unless `runner` is given)
+        @param incremental skips scripties that are unchanged since their last successful run
+        @param force runs every scriptie in incremental mode regardless, refreshing its state
+        @param invalidated list of stages to run again in incremental mode, along with every later stage
+        @param stage_jobs number of numbered passes to run concurrently for stages marked with '&' (default: all CPUs)
+        @param executor runs concurrent directory flows in a pool of 'thread's or 'process'es
+        @param index caches directory listings in .flowindex at the top of recursive flows
+        @param admission a FlowAdmission that holds back new directory flows while the node is loaded
+        @param sql_batch runs the SQL scripties of each 'stage', or of the whole 'style', in one interpreter session
+        @param history a FlowHistory that records how long each directory flow and stage takes, so that concurrent 
+        flows start with the longest expected work and the run can estimate the time left
+        @param plan a FlowPlan from which to take the subdirectories, scripties and their command lines, rather than listing directories
+        @param scratch a FlowScratch in which to run each directory's stages, in a copy on local disk, rather than in the directory
+        '''
         super(Flow, self).__init__()
         self._rootdir = rootdir
         self._dryrun = dryrun
@@ -208,11 +1022,26 @@ class Flow(object):
         self._quiet = quiet
         self._interactive = interactive
         self._style = style
-        self._languages = languages if languages is not None else FlowLanguages()
-        self._styles = styles if styles is not None else FlowStyles()        
-        self._runner = runner if runner is not None else FlowExecution(dryrun, quiet, interactive, keep_going)
+        self._languages = languages if languages is not None else registry()[1]
+        self._styles = styles if styles is not None else FlowStyles(registry()[0]) # copied, since styles() may add to it        
+        self._runner = runner if runner is not None else FlowExecution(dryrun, quiet, interactive, keep_going, report, logs, cache, warm, journal, cpus)
+        self._keep_going = keep_going
+        self._report = report
+        self._journal = journal
         self._excluded_dirs = excluded_dirs
         self._excluded_prefix = excluded_prefix
+        self._incremental = incremental
+        self._force = force
+        self._invalidated = invalidated
+        self._stage_jobs = stage_jobs if stage_jobs is not None else mp.cpu_count()
+        self._executor = executor
+        self._index = index
+        self._flowindex = None # the FlowIndex of the last _walk, whose listings spawned flows reuse
+        self._admission = admission
+        self._sql_batch = sql_batch
+        self._history = history
+        self._plan = plan
+        self._scratch = scratch
         # print self._excluded_dirs, self._excluded_prefix
 
     def style(self, style = None):
@@ -230,44 +1059,72 @@ class Flow(object):
             self._rootdir = rootdir
         return self._rootdir
 
-    def run(self, depth = 0, nproc = 1, style = None):
+    def run(self, depth = 0, nproc = 1, style = None, pool = None):
         '''Run from the current directory. 
         @param depth is an integer for how many subdirectories to execute in level-by-level order (default: 0 for no recursion).
-        @param nproc is an integer for the number of processors to execute concurrently.
+        @param nproc is an integer for the number of directories to execute concurrently. Each directory
+        starts as soon as all of its subdirectories are finished.
         @param style is the style in which to run.
+        @param pool is a FlowPool to run subdirectories in, which is left open (default: a pool of `nproc` workers for this run only).
+        Without keep_going, the first failure terminates the pool, along with the scripties it is running.
         '''
         
         if style is None:
             style = self._style
         self._logger('Running flow [rootdir=%s] depth=%d nproc=%d' % (self._rootdir, depth, nproc))
         if depth > 0:
-            n = 0
-            pool = None
-            if nproc > 1:
-                pool = mp.Pool(nproc)
-            for level in self._bylevel_iter(self._rootdir):
-                n = level[0]
-                self._logger('Running Level %d' % (n))
-                flows = [self.spawn(p) for p in sorted(level[1:])]
-                if pool is None:
-                    map(lambda f: f.run(0,1), flows)
-                else:
-                    pool.map(_pool_run_one, flows)
+            _cancelled.clear()
+            if pool is not None:
+                self._run_dag(pool, style)
+            elif nproc > 1:
+                with FlowPool(self, nproc, self._executor) as pool:
+                    self._run_dag(pool, style)
+            else:
+                levels = self._bylevel_iter(self._rootdir)
+                expected = self._expected([p for level in levels for p in level[1:]])
+                finished = set()
+                for level in levels:
+                    self._logger('Running Level %d' % (level[0]))
+                    for p in sorted(level[1:]):
+                        try:
+                            self.spawn(os.path.join(self._rootdir, p)).run(0, 1, style)
+                        except Exception, e:
+                            if not self._keep_going:
+                                self._log_cancelled(len(finished), [p], [], sum([len(l) - 1 for l in levels]) - len(finished) - 1)
+                            raise
+                        finished.add(p)
+                        self._log_eta(expected, finished, 1)
         
         self._run_package(style)
 
     def __deepcopy__(self):
-        return Flow(rootdir = self._rootdir, 
-                    dryrun = self._dryrun, 
-                    interactive = self._interactive, 
-                    quiet = self._quiet, 
-                    numbered = self._numbered, 
-                    style = self._style,
-                    styles = self._styles,
-                    languages = self._languages,
-                    runner = self._runner,
-                    excluded_dirs = self._excluded_dirs,
-                    excluded_prefix = self._excluded_prefix)
+        f = Flow(rootdir = self._rootdir, 
+                 dryrun = self._dryrun, 
+                 interactive = self._interactive, 
+                 quiet = self._quiet, 
+                 numbered = self._numbered, 
+                 style = self._style,
+                 styles = self._styles,
+                 languages = self._languages,
+                 runner = self._runner,
+                 keep_going = self._keep_going,
+                 report = self._report,
+                 journal = self._journal,
+                 excluded_dirs = self._excluded_dirs,
+                 excluded_prefix = self._excluded_prefix,
+                 incremental = self._incremental,
+                 force = self._force,
+                 invalidated = self._invalidated,
+                 stage_jobs = self._stage_jobs,
+                 executor = self._executor,
+                 index = self._index,
+                 admission = self._admission,
+                 sql_batch = self._sql_batch,
+                 history = self._history,
+                 plan = self._plan,
+                 scratch = self._scratch)
+        f._flowindex = self._flowindex
+        return f
 
     def spawn(self, rootdir):
         f = self.__deepcopy__()
@@ -276,87 +1133,317 @@ class Flow(object):
 
     # Private methods --------------------------------------------
 
-    def _find_scripties(self, prefix):
+    def _find_passes(self, prefix, listings = None):
+        '''returns a list of (number, scripties) for each pass in order, where the unnumbered pass is None.
+        @param listings dict in which to keep each directory's scriptie listing, so it is listed only once per flow
+        '''
+        if self._plan is not None:
+            return self._plan.passes(self._rootdir, prefix)
+        if listings is None:
+            listings = dict()
+        (d, base) = os.path.split(prefix)
+        if d not in listings:
+            names = self._flowindex.files(os.path.join(self._rootdir, d)) if self._flowindex is not None else None
+            if names is None:
+                names = self._listdir(os.path.join(self._rootdir, d))[1]
+            listings[d] = (set(names), _index_passes(names))
+        (names, bypass) = listings[d]
+
+        passes = list()
         l = list()
         
         # first to the simple thing
         for ext in self._languages:
-            fn = '%s.%s' % (prefix, ext)
-            if os.path.isfile(fn):
-                l.append(fn)
-        
+            fn = '%s.%s' % (base, ext)
+            if fn in names:
+                l.append(os.path.join(d, fn))
+        if len(l) > 0:
+            passes.append((None, l))
         
         if self._numbered:
-            # look for files like "model1.sh", "model10.sh", and sort by number
-            bynum = dict()
-            fns = glob('%s[0-9]*' % (prefix))
-            for fn in fns:
-                (name, ext) = os.path.splitext(os.path.basename(fn))
-                try:
-                    n = int(name[len(prefix):len(name)])
-                    if n >= 0:
-                        if n not in bynum:
-                            bynum[n] = []
-                        bynum[n].append(fn)
-                except ValueError, e:
-                    pass
-            
+            # files like "model1.sh", "model10.sh", sorted by number
+            bynum = bypass.get(base, {})
             for i in sorted(bynum):
+                l = list()
                 for ext in self._languages:
                     for fn in bynum[i]:
-                        if fn.endswith(ext) and os.path.isfile(fn):
-                            l.append(fn)
+                        if fn.endswith(ext):
+                            l.append(os.path.join(d, fn))
+                if len(l) > 0:
+                    passes.append((i, l))
 
-        return l
+        return passes
+
+    def _find_scripties(self, prefix, listings = None):
+        return [fn for (n, fns) in self._find_passes(prefix, listings) for fn in fns]
         
-    def _run_scriptie(self, prefix):
-        for fn in self._find_scripties(prefix):
-            self._runner.run(fn)
+    def _run_scriptie(self, prefix, state = None, listings = None, session = None, cwd = None, failed = None):
+        '''Runs all passes for the stage `prefix`, and returns how many there were. A stage ending with '&' (e.g., "download&")
+        runs its numbered passes concurrently, up to `stage_jobs` at a time, after the unnumbered pass.
+        @param session a FlowSQLSession for the SQL scripties, except those of concurrent passes
+        @param cwd directory in which the scripties run (default: the rootdir)
+        @param failed list to which the scripties that exited with an error are appended (with keep-going)
+        '''
+        cwd = cwd if cwd is not None else self._rootdir
+        parallel = prefix.endswith('&')
+        if parallel:
+            prefix = prefix[0:len(prefix)-1]
+        passes = self._find_passes(prefix, listings)
+        if state is not None and len(passes) > 0 and prefix in self._invalidated:
+            state.invalidate()
+
+        def options(fn, session):
+            '''the session for SQL scripties, or else the command line from the plan'''
+            if session is not None and fn.lower().endswith('.sql'):
+                return { 'session': session }
+            return { 'argv': self._plan.argv(self._rootdir, fn) } if self._plan is not None else {}
+        def run_pass((n, fns), session = session):
+            for fn in fns:
+                status = self._runner.run(fn, state=state, cwd=cwd, dirp=self._rootdir, stage=prefix, npass=n, **options(fn, session))
+                if status not in (0, None) and failed is not None:
+                    failed.append(fn)
+        if parallel and not (self._interactive or self._dryrun) and self._stage_jobs > 1:
+            numbered = [p for p in passes if p[0] is not None]
+            map(run_pass, [p for p in passes if p[0] is None])
+            if len(numbered) > 0:
+                pool = ThreadPool(min(self._stage_jobs, len(numbered)))
+                try:
+                    pool.map(lambda p: run_pass(p, None), numbered) # the stage is a barrier before the next one
+                finally:
+                    pool.close()
+                    pool.join()
+        else:
+            map(run_pass, passes)
+        return len(passes)
 
     def _run_package(self, style = 'default'):
-        '''Changes to the rootdir and then runs all commands for the package'''
-        prev_dir = os.path.abspath(os.getcwd())
+        '''Runs all commands for the package, with the rootdir as their working directory'''
+        if self._journal is not None and self._journal.done(self._rootdir):
+            self._logger('Skipping finished package [%s]' % (self._rootdir))
+            return
         self._logger('Running package with %s style [%s]' % (style, self._rootdir))
-        os.chdir(self._rootdir)
+        listings = dict()
+        scratch = self._scratch is not None and not (self._interactive or self._dryrun)
+        if scratch: # only with scripties to run, as staging reads every file of the directory
+            scratch = any([len(self._find_passes(scriptie.rstrip('&'), listings)) > 0 for scriptie in self._styles[style]])
+        if self._journal is not None and not self._dryrun:
+            self._journal.started(self._rootdir, scratch=scratch)
+        state = FlowState(self._rootdir, force=self._force) if self._incremental else None
+        start = time.time()
+        (workdir, staged) = (self._rootdir, None)
+        if scratch:
+            (workdir, staged) = self._scratch.stage(self._rootdir)
+            self._logger('Staged package [%s] in %s' % (self._rootdir, workdir))
+        session = None
+        if self._sql_batch is not None and not (self._interactive or self._dryrun):
+            session = self._runner.sql_session(workdir)
+        failed = list()
+        status = 1
         try:
             for scriptie in self._styles[style]:
-                self._run_scriptie(scriptie)
+                stagestart = time.time()
+                npasses = self._run_scriptie(scriptie, state, listings, session, workdir, failed)
+                if session is not None and self._sql_batch == 'stage':
+                    session.close() # the next stage starts its own session
+                if self._history is not None and not self._dryrun and npasses > 0:
+                    self._history.record(self._rootdir, scriptie.rstrip('&'), time.time() - stagestart)
+            if session is not None:
+                session.close() # before its files are copied back
+            if staged is not None and len(failed) > 0: # so its work is lost, and the journal and report say so
+                self._logger('Not copying back the scratch copy of [%s], as %s failed' % (self._rootdir, ', '.join(failed)))
+            else:
+                if staged is not None:
+                    n = self._scratch.sync(self._rootdir, workdir, staged)
+                    self._logger('Copied %d new or changed files back to [%s]' % (n, self._rootdir))
+                status = 0
+            if self._history is not None and not self._dryrun and status == 0:
+                self._history.record(self._rootdir, None, time.time() - start)
         finally:
-            os.chdir(prev_dir)
+            if session is not None:
+                session.close()
+            if staged is not None and self._scratch.cleanup(workdir, status == 0 and len(failed) == 0):
+                self._logger('Kept the scratch copy of [%s] in %s' % (self._rootdir, workdir))
+            if state is not None and not self._dryrun and (staged is None or status == 0): # not for outputs left in a scratch copy
+                state.save()
+            if self._journal is not None and not self._dryrun:
+                self._journal.finished(self._rootdir, None, status)
+            if self._report is not None and not self._dryrun:
+                self._report.append({ 'kind': 'flow', 'dir': os.path.abspath(self._rootdir), 'stage': style, 
+                                      'status': status, 'start': round(start, 3), 
+                                      'wall': round(time.time() - start, 3), 'worker': _worker() })
 
 
-    def _iter_dirs(self, root):
-        results = deque()
+    def _run_dag(self, pool, style):
+        '''Runs each subdirectory flow in `pool` as soon as all of its own subdirectories have finished.
+        At most as many flows as the pool has workers are handed to it at once, and the rest wait in `ready`,
+        so that prioritize(), rather than the order in which the pool queues them, decides which start first.'''
+        alldirs = self._iter_dirs(self._rootdir)
+        waiting = dict([(p, 0) for p in alldirs]) # number of unfinished subdirectories
+        for p in alldirs:
+            parent = os.path.dirname(p)
+            if parent in waiting:
+                waiting[parent] += 1
+        expected = self._expected(alldirs)
+        ranks = dict() # expected seconds from the start of each flow until the top directory can start
+        for p in alldirs: # parents come first
+            ranks[p] = expected.get(p, 0.0) + ranks.get(os.path.dirname(p), 0.0)
+        def prioritize(ready):
+            '''sorts `ready` so that pop() returns the longest expected path, and then the first alphabetically'''
+            ready.sort(reverse=True)
+            ready.sort(key=lambda p: ranks[p]) # stable, so equal ranks stay in reverse alphabetical order
+        ready = [p for p in alldirs if waiting[p] == 0]
+        prioritize(ready)
+        finished = set()
+
+        self._logger('Running %d directories' % (len(alldirs)))
+        done = Queue.Queue()
+        running = 0
+        inflight = set() # handed to the pool
+        error = None
+        errors = dict() # of each directory whose flow failed
+        admitted = lambda: len(inflight) == 0 or self._admission is None or self._admission.ok() # each time a worker frees up
+        while running > 0 or (len(ready) > 0 and error is None):
+            while len(ready) > 0 and error is None and len(inflight) < max(pool.nproc(), 1) and admitted():
+                p = ready.pop()
+                if self._journal is not None and self._journal.done(os.path.join(self._rootdir, p)):
+                    self._logger('Skipping finished package [%s]' % (os.path.join(self._rootdir, p)))
+                    done.put((p, None)) # without a round trip to the pool, which may be remote
+                else:
+                    pool.submit(os.path.join(self._rootdir, p), style, p, done.put)
+                    inflight.add(p)
+                running += 1
+
+            try:
+                (p, e) = done.get(True, 1.0) # with a timeout, so that signals are delivered and admission is rechecked
+            except Queue.Empty:
+                continue
+            running -= 1
+            inflight.discard(p)
+            finished.add(p)
+            self._log_eta(expected, finished, pool.nproc())
+            if e is not None:
+                errors[p] = e
+            if e is not None and error is None:
+                error = e # stop dispatching, and let running flows finish unless failing fast
+                if not self._keep_going:
+                    cause = _cancel_cause if _cancelled.is_set() else None # whose scripties, in this process, failed first
+                    failed = os.path.relpath(cause, os.path.abspath(self._rootdir)) if cause is not None else p
+                    failed = failed if failed in waiting else p
+                    self._logger('ERROR: Flow for %s failed, so cancelling %d running flows' % (os.path.join(self._rootdir, failed), len(inflight)))
+                    _cancel(cause)
+                    while failed != p and failed in inflight and failed not in errors: # e.g., a sibling that _cancel() killed came back first
+                        try:
+                            (q, qe) = done.get(True, 1.0)
+                        except Queue.Empty:
+                            continue
+                        if qe is not None:
+                            errors[q] = qe
+                    error = errors.get(failed, error) # raise the failure itself, rather than what it cancelled
+                    pool.terminate() # which stops process workers along with their scripties
+                    self._log_cancelled(len(finished) - 1, [failed], sorted((inflight | set([p])) - set([failed])), 
+                                        len(alldirs) - len(finished) - len(inflight))
+                    break
+            parent = os.path.dirname(p)
+            if parent in waiting:
+                waiting[parent] -= 1
+                if waiting[parent] == 0:
+                    ready.append(parent)
+                    prioritize(ready)
+
+        if error is not None:
+            raise error
+
+    def _log_cancelled(self, nfinished, failed, cancelled, nwaiting):
+        '''logs what became of a run that failed fast'''
+        self._logger('ERROR: %d directories finished, %d failed (%s), %d were cancelled%s, and %d never started (counting the top directory)' % 
+                     (nfinished, len(failed), ', '.join(failed), len(cancelled), 
+                      ' (%s)' % (', '.join(cancelled)) if len(cancelled) > 0 else '', nwaiting + 1))
+
+    def _expected(self, dirs):
+        '''returns { subdirectory or '' for the top directory: expected seconds } for `dirs` relative to the rootdir, 
+        from the history. Directories that never ran are expected to take the median time of those that did.
+        Empty if there is no history, or it knows none of them.'''
+        if self._history is None:
+            return dict()
+        expected = dict()
+        for p in list(dirs) + ['']:
+            e = self._history.expected(os.path.join(self._rootdir, p))
+            if e is not None:
+                expected[p] = e
+        if len(expected) > 0:
+            median = sorted(expected.values())[len(expected) / 2]
+            for p in list(dirs) + ['']:
+                expected.setdefault(p, median)
+        return expected
+
+    def _log_eta(self, expected, finished, nproc):
+        '''logs progress and the expected time left, given the `finished` subdirectories and `nproc` flows at once'''
+        if len(expected) == 0:
+            return
+        left = sum([e for (p, e) in expected.items() if p != '' and p not in finished]) / max(nproc, 1) + expected['']
+        self._logger('Finished %d of %d directories, about %d:%02d:%02d left' % (len(finished), len(expected) - 1,
+                                                                                 left / 3600, left % 3600 / 60, left % 60))
+
+    def _listdir(self, dirp):
+        '''returns (subdirectories minus exclusions, scriptie filenames) in `dirp`. 
+        Exclusions are checked before anything is stat'ed, and d_type is used instead of stat where available.'''
+        dirs = list()
+        files = list()
+        included = lambda name: name not in self._excluded_dirs and not _match_prefixes(name, self._excluded_prefix)
+        scriptie = lambda name: any([name.endswith(ext) for ext in self._languages])
+        if scandir is not None:
+            for e in scandir(dirp):
+                if scriptie(e.name) and e.is_file():
+                    files.append(e.name)
+                elif included(e.name) and e.is_dir():
+                    dirs.append(e.name)
+        else:
+            for name in os.listdir(dirp):
+                p = os.path.join(dirp, name)
+                if scriptie(name) and os.path.isfile(p):
+                    files.append(name)
+                elif included(name) and os.path.isdir(p):
+                    dirs.append(name)
+        return (dirs, files)
+
+    def _walk(self, root):
+        '''returns a breadth-first list of (depth, pathname relative to root) for subdirectories minus exclusions'''
+        if self._plan is not None:
+            return self._plan.walk(root)
+        index = None
+        if self._index:
+            index = FlowIndex(root, { 'excluded_dirs': self._excluded_dirs, 
+                                      'excluded_prefix': self._excluded_prefix,
+                                      'languages': self._languages })
+        results = list()
         q = deque()
-        q.append(root)
+        q.append((0, ''))
         while len(q) > 0:
-            dirp = q.popleft()
-            for dirent in os.listdir(dirp):
-                p = os.path.join(dirp, dirent)
-                if os.path.isdir(p) \
-                   and dirent not in self._excluded_dirs \
-                   and not _match_prefixes(dirent, self._excluded_prefix):
-                    q.append(p)
-                    results.append(p[len(root)+1:]) # strip root prefix
+            (depth, rel) = q.popleft()
+            dirp = os.path.join(root, rel)
+            if index is not None:
+                (dirs, files) = index.listdir(dirp, rel, self._listdir)
+            else:
+                (dirs, files) = self._listdir(dirp)
+            for dirent in dirs:
+                p = os.path.join(rel, dirent)
+                q.append((depth+1, p))
+                results.append((depth+1, p))
+        if index is not None:
+            index.save()
+            self._flowindex = index
         return results
 
+    def _iter_dirs(self, root):
+        return deque([p for (depth, p) in self._walk(root)])
+
     def _bylevel_iter(self, root):
         '''returns an inverse level-ordered list of pathnames to subdirectories relative to root'''
-        # fetch all subdirs minus exclusions
-        alldirs = self._iter_dirs(root)
-
-        # find max depth
-        maxdepth = 0
-        for p in alldirs:
-            depth = len(p.split('/'))
-            maxdepth = max(depth, maxdepth)
-
-        # create level-based list
-        results = [[i+1] for i in xrange(0, maxdepth)]
-
-        # insert all paths into level-based list
-        for p in alldirs:
-            depth = len(p.split('/'))
+        # create level-based list of all subdirs minus exclusions, which arrive in breadth-first order
+        results = list()
+        for (depth, p) in self._walk(root):
+            if len(results) < depth:
+                results.append([depth])
             results[depth-1].append(p)
 
         # invert the list
@@ -0,0 +1,91 @@
+'''
+A history of how long each directory flow and stage took in past runs, for scheduling the longest work first
+'''
+import json
+import os
+import os.path
+
+class FlowHistory(object):
+    '''Appends a JSON line with the wall time of each directory flow and of each of its stages, and keeps an
+    exponentially weighted moving average of them, so that one unusual run does not dominate the estimates.
+    Each process executor appends to the same file, and the file is compacted to one line per estimate when it
+    is loaded, once it has grown well beyond that.
+    Supports the FLOW_HISTORY_ALPHA environment variable (default 0.5), the weight of the latest run.'''
+    def __init__(self, fn, alpha = None):
+        '''@param fn history filename (e.g., .flowhistory in the top directory)
+        @param alpha weight of the latest run in each estimate, between 0 and 1
+        '''
+        super(FlowHistory, self).__init__()
+        self._fn = os.path.abspath(fn)
+        self._alpha = alpha if alpha is not None else float(os.getenv('FLOW_HISTORY_ALPHA', '0.5'))
+        self._estimates = dict() # dir to { stage, or None for the whole flow: seconds }
+        nlines = self._load()
+        if nlines > 2 * sum([len(d) for d in self._estimates.values()]) + 100:
+            self._compact()
+        self._open()
+
+    def _load(self):
+        if not os.path.isfile(self._fn):
+            return 0
+        nlines = 0
+        f = open(self._fn, 'rb')
+        try:
+            for line in f:
+                nlines += 1
+                try:
+                    r = json.loads(line)
+                    self._update(r['dir'], r.get('stage'), float(r['wall']))
+                except (ValueError, KeyError), e: # a record cut short by a crash
+                    continue
+        finally:
+            f.close()
+        return nlines
+
+    def _update(self, dirp, stage, wall):
+        d = self._estimates.setdefault(dirp, dict())
+        e = d.get(stage)
+        d[stage] = wall if e is None else self._alpha * wall + (1.0 - self._alpha) * e
+
+    def _compact(self):
+        tmpfn = '%s.tmp' % (self._fn)
+        f = open(tmpfn, 'w')
+        try:
+            for (dirp, d) in sorted(self._estimates.items()):
+                for (stage, wall) in sorted(d.items()):
+                    f.write(json.dumps({ 'dir': dirp, 'stage': stage, 'wall': round(wall, 3) }, sort_keys=True) + '\n')
+        finally:
+            f.close()
+        os.rename(tmpfn, self._fn)
+
+    def _open(self):
+        self._fd = os.open(self._fn, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+
+    def __getstate__(self):
+        '''each process executor opens the history for itself'''
+        d = dict(self.__dict__)
+        del d['_fd']
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._open()
+
+    def filename(self):
+        return self._fn
+
+    def expected(self, dirp, stage = None):
+        '''returns the estimated seconds for the flow of `dirp`, or one of its stages, or None if it never ran.
+        A flow that never finished is estimated from its stages, if any of them did.'''
+        d = self._estimates.get(os.path.abspath(dirp or '.'), {})
+        if stage is None and None not in d and len(d) > 0:
+            return sum(d.values())
+        return d.get(stage)
+
+    def record(self, dirp, stage, wall):
+        '''records that the flow of `dirp`, or its `stage` if not None, took `wall` seconds'''
+        dirp = os.path.abspath(dirp or '.')
+        self._update(dirp, stage, wall)
+        os.write(self._fd, json.dumps({ 'dir': dirp, 'stage': stage, 'wall': round(wall, 3) }, sort_keys=True) + '\n')
+
+    def close(self):
+        os.close(self._fd)
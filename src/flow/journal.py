@@ -0,0 +1,125 @@
+'''
+A crash-safe journal of the directory flows and scripties of a run, from which a later run can resume
+'''
+import hashlib
+import json
+import os
+import os.path
+import time
+
+class FlowJournal(object):
+    '''Appends a JSON line when each directory flow or scriptie starts and finishes, and fsyncs it,
+    so the journal survives a SIGKILL or a reboot of the node.
+    When resuming, the journal of the earlier runs tells which work already finished successfully:
+    a directory flow is done if it finished and none of its scripties failed or was interrupted,
+    and a scriptie is done if its last run finished with status 0. The scripties of a flow that ran in a
+    scratch copy count only once that flow finished with status 0, since their files are lost otherwise.'''
+    def __init__(self, fn, resume = False):
+        '''@param fn journal filename
+        @param resume keeps the existing journal and skips the work it records as done, rather than starting a new one
+        '''
+        super(FlowJournal, self).__init__()
+        self._fn = os.path.abspath(fn)
+        self._status = dict() # last status of each (dir, scriptie) in earlier runs, or None if it never finished
+        if resume and os.path.isfile(self._fn):
+            self._load()
+        elif os.path.isfile(self._fn):
+            os.unlink(self._fn)
+        self._failed = set([d for ((d, scriptie), status) in self._status.items() if scriptie is not None and status != 0])
+        self._extracted = dict() # number of records each extracted journal started with
+        self._open()
+
+    def _load(self):
+        pending = dict() # statuses of the scripties of each flow running in a scratch copy, until it finishes
+        f = open(self._fn, 'rb')
+        try:
+            for line in f:
+                try:
+                    r = json.loads(line)
+                except ValueError, e: # a record cut short by a crash
+                    continue
+                key = (r['dir'], r.get('scriptie'))
+                status = r.get('status') if r['event'] == 'finish' else None
+                if key[1] is None and r.get('scratch'):
+                    pending[key[0]] = dict()
+                elif key[1] is not None and key[0] in pending:
+                    pending[key[0]][key] = status
+                    continue
+                elif key[1] is None and key[0] in pending and r['event'] == 'finish':
+                    scripties = pending.pop(key[0])
+                    if status == 0: # copied back
+                        self._status.update(scripties)
+                self._status[key] = status
+        finally:
+            f.close()
+
+    def _open(self):
+        self._fd = os.open(self._fn, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+
+    def __getstate__(self):
+        '''each process executor opens the journal for itself'''
+        d = dict(self.__dict__)
+        del d['_fd']
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._open()
+
+    def filename(self):
+        return self._fn
+
+    def done(self, dirp, scriptie = None):
+        '''True if the flow for `dirp`, or its `scriptie`, already finished successfully in an earlier run'''
+        dirp = os.path.abspath(dirp or '.')
+        if self._status.get((dirp, scriptie)) != 0:
+            return False
+        return scriptie is not None or dirp not in self._failed
+
+    def started(self, dirp, scriptie = None, scratch = False):
+        '''@param scratch whether the flow of `dirp` runs in a scratch copy, whose scripties count only if it finishes'''
+        record = { 'event': 'start', 'dir': os.path.abspath(dirp or '.'), 'scriptie': scriptie, 'time': round(time.time(), 3) }
+        if scratch:
+            record['scratch'] = True
+        self._append(record)
+
+    def finished(self, dirp, scriptie = None, status = 0):
+        self._append({ 'event': 'finish', 'dir': os.path.abspath(dirp or '.'), 'scriptie': scriptie, 'status': status,
+                       'time': round(time.time(), 3) })
+
+    def extract(self, dirp):
+        '''Starts a journal of its own for the flow of `dirp`, e.g., on another host, holding the scripties of `dirp` that
+        are already done, and returns its filename. Flows append to it instead of loading this whole journal.'''
+        dirp = os.path.abspath(dirp or '.')
+        fn = '%s.%s' % (self._fn, hashlib.sha1(dirp).hexdigest()[0:16])
+        done = [scriptie for ((d, scriptie), status) in sorted(self._status.items()) if d == dirp and scriptie is not None and status == 0]
+        f = open(fn, 'w')
+        try:
+            for scriptie in done:
+                f.write(json.dumps({ 'event': 'finish', 'dir': dirp, 'scriptie': scriptie, 'status': 0, 'time': 0 }, sort_keys=True) + '\n')
+        finally:
+            f.close()
+        self._extracted[fn] = len(done)
+        return fn
+
+    def merge(self, fn):
+        '''Appends the new records of the journal `fn`, from extract(), to this one, and removes it'''
+        skip = self._extracted.pop(fn, 0)
+        if not os.path.isfile(fn):
+            return
+        f = open(fn, 'rb')
+        try:
+            lines = [line for line in f if line.endswith('\n')][skip:] # not a record cut short by a crash
+        finally:
+            f.close()
+        if len(lines) > 0:
+            os.write(self._fd, ''.join(lines))
+            os.fsync(self._fd)
+        os.unlink(fn)
+
+    def _append(self, record):
+        os.write(self._fd, json.dumps(record, sort_keys=True) + '\n') # one write, so concurrent records never interleave
+        os.fsync(self._fd)
+
+    def close(self):
+        os.close(self._fd)
@@ -0,0 +1,160 @@
+'''
+Per-directory, per-stage log files for scriptie output, with a multiplexed console view
+'''
+import gzip
+import os
+import os.path
+import shutil
+import sys
+import threading
+
+_lock = threading.Lock()  # guards _files and the console
+_files = dict()           # open FlowLogFile objects by path, shared by concurrent passes of a stage
+
+def _ingest_int_from_env(var, default):
+    return int(os.getenv(var, str(default)))
+
+class FlowLogFile(object):
+    '''An append-only log file that rotates to .1, .2, etc. once it would grow beyond `maxbytes`'''
+    def __init__(self, fn, maxbytes, backups, compress):
+        super(FlowLogFile, self).__init__()
+        self._fn = fn
+        self._maxbytes = maxbytes
+        self._backups = backups
+        self._compress = compress
+        self._refs = 0
+        self._lock = threading.Lock()
+        self._open()
+
+    def _open(self):
+        self._f = open(self._fn, 'ab')
+        self._size = self._f.tell()
+
+    def _rotated(self, i):
+        return '%s.%d%s' % (self._fn, i, '.gz' if self._compress else '')
+
+    def _rotate(self):
+        self._f.close()
+        if self._backups > 0:
+            for i in xrange(self._backups - 1, 0, -1):
+                if os.path.exists(self._rotated(i)):
+                    os.rename(self._rotated(i), self._rotated(i + 1))
+            if self._compress:
+                src = open(self._fn, 'rb')
+                dst = gzip.open(self._rotated(1), 'wb')
+                try:
+                    shutil.copyfileobj(src, dst)
+                finally:
+                    src.close()
+                    dst.close()
+                os.unlink(self._fn)
+            else:
+                os.rename(self._fn, self._rotated(1))
+        else:
+            os.unlink(self._fn)
+        self._open()
+
+    def write(self, data):
+        with self._lock:
+            if self._maxbytes > 0 and self._size > 0 and self._size + len(data) > self._maxbytes:
+                self._rotate()
+            self._f.write(data)
+            self._size += len(data)
+
+    def close(self):
+        with self._lock:
+            self._f.close()
+
+class FlowLogs(object):
+    '''Captures the stdout and stderr of each scriptie into <dir>/_logs/<stage>.stdout.log and
+    <stage>.stderr.log, and echoes it to the console with each line prefixed by directory and stage.
+    Supports FLOW_LOG_DIR (default '_logs'), FLOW_LOG_MAXBYTES (default 10485760), FLOW_LOG_BACKUPS
+    (default 3), FLOW_LOG_COMPRESS (default 0) and FLOW_LOG_CONSOLE (default 1) environment variables.'''
+    def __init__(self, logdir = None, maxbytes = None, backups = None, compress = None, console = None):
+        super(FlowLogs, self).__init__()
+        self._logdir = logdir if logdir is not None else os.getenv('FLOW_LOG_DIR', '_logs')
+        self._maxbytes = maxbytes if maxbytes is not None else _ingest_int_from_env('FLOW_LOG_MAXBYTES', 10485760)
+        self._backups = backups if backups is not None else _ingest_int_from_env('FLOW_LOG_BACKUPS', 3)
+        self._compress = compress if compress is not None else _ingest_int_from_env('FLOW_LOG_COMPRESS', 0) != 0
+        self._console = console if console is not None else _ingest_int_from_env('FLOW_LOG_CONSOLE', 1) != 0
+
+    def relay(self, cwd, stage, scriptie):
+        '''returns a FlowLogRelay for one execution of `scriptie` in `cwd`'''
+        dirp = os.path.join(cwd or '.', self._logdir)
+        with _lock:
+            if not os.path.isdir(dirp):
+                os.makedirs(dirp)
+        stage = stage or os.path.splitext(os.path.basename(scriptie))[0]
+        tag = '[%s:%s] ' % (os.path.relpath(cwd or '.'), stage)
+        return FlowLogRelay(self._open(os.path.join(dirp, '%s.stdout.log' % (stage))),
+                            self._open(os.path.join(dirp, '%s.stderr.log' % (stage))),
+                            tag if self._console else None, scriptie)
+
+    def _open(self, fn):
+        fn = os.path.abspath(fn)
+        with _lock:
+            if fn not in _files:
+                _files[fn] = FlowLogFile(fn, self._maxbytes, self._backups, self._compress)
+            _files[fn]._refs += 1
+            return _files[fn]
+
+def _release(f):
+    with _lock:
+        f._refs -= 1
+        if f._refs == 0:
+            f.close()
+            del _files[f._fn]
+
+class FlowLogRelay(object):
+    '''Drains a child's stdout and stderr pipes in reader threads, so the child never blocks on a full pipe,
+    copying whole lines into its log files and onto the console'''
+    def __init__(self, outlog, errlog, tag, scriptie):
+        super(FlowLogRelay, self).__init__()
+        self._logs = (outlog, errlog)
+        self._tag = tag
+        self._scriptie = scriptie
+        self._threads = list()
+
+    def start(self, out, err):
+        '''starts draining the pipe file objects `out` and `err`'''
+        for (pipe, log, console) in ((out, self._logs[0], sys.stdout), (err, self._logs[1], sys.stderr)):
+            log.write('==> %s <==\n' % (self._scriptie))
+            t = threading.Thread(target=self._drain, args=(pipe, log, console))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def _drain(self, pipe, log, console):
+        partial = ''
+        fd = pipe.fileno()
+        while True:
+            data = os.read(fd, 65536)
+            if data == '':
+                break
+            lines = (partial + data).split('\n')
+            partial = lines.pop()
+            if len(partial) >= 65536: # keeps memory bounded for output without newlines
+                lines.append(partial)
+                partial = ''
+            if len(lines) > 0:
+                self._emit(lines, log, console)
+        if partial != '':
+            self._emit([partial], log, console)
+        pipe.close()
+
+    def _emit(self, lines, log, console):
+        log.write(''.join(['%s\n' % (l) for l in lines]))
+        if self._tag is not None:
+            with _lock:
+                try:
+                    console.write(''.join(['%s%s\n' % (self._tag, l) for l in lines]))
+                    console.flush()
+                except IOError, e: # e.g., a closed pipe, but the child must still be drained
+                    self._tag = None
+
+    def join(self):
+        '''waits for both pipes to close, then releases the log files'''
+        for t in self._threads:
+            t.join()
+        for log in self._logs:
+            _release(log)
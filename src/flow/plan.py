@@ -0,0 +1,123 @@
+'''
+Compiled execution plans: the directories, scripties and command lines of a flow, resolved once and run many times
+'''
+import json
+import os
+import os.path
+
+from flow import FlowExecution
+
+def _native(o):
+    '''str for the unicode strings of a decoded JSON document, so command lines are unchanged'''
+    if isinstance(o, unicode):
+        return o.encode('utf-8')
+    if isinstance(o, list):
+        return [_native(e) for e in o]
+    if isinstance(o, dict):
+        return dict([(_native(k), _native(v)) for (k, v) in o.items()])
+    return o
+
+class _FlowRecorder(FlowExecution):
+    '''returns the command line of each scriptie instead of running it'''
+    def _execcmd(self, cmdarray, **kw):
+        return cmdarray
+
+class FlowPlan(dict):
+    '''data type for a flow whose directories, scriptie passes and interpreter command lines are resolved ahead
+    of time, so that running it lists no directories. Flow takes its subdirectories and scripties from a plan,
+    and runs the command lines in it, when given one.
+    Each directory's mtime is kept too, since a directory's mtime changes when entries are added or removed,
+    so that stale() can tell whether the tree still matches the plan.'''
+    def __init__(self, fn = None):
+        '''@param fn plan file to load (default: an empty plan, to compile())'''
+        super(FlowPlan, self).__init__()
+        if fn is not None:
+            f = open(fn)
+            try:
+                self.update(_native(json.load(f)))
+            finally:
+                f.close()
+            if self.get('version') != 1:
+                raise ValueError('%s is not a flow plan' % (fn))
+
+    def compile(self, flow, depth = 0, style = None):
+        '''Resolves the plan for running `flow` as Flow.run(depth, style=style) would, returning the number of scripties'''
+        if style is None:
+            style = flow.style()
+        root = os.path.abspath(flow.rootdir())
+        stages = list(flow.styles()[style])
+        walk = flow._walk(root) if depth > 0 else []
+        recorder = _FlowRecorder(quiet=flow._runner._quiet) # which changes some command lines
+        dirs = dict()
+        n = 0
+        for rel in [''] + [p for (d, p) in walk]:
+            dirp = os.path.join(root, rel)
+            g = flow.spawn(dirp)
+            listings = dict()
+            passes = dict()
+            argv = dict()
+            for stage in stages:
+                prefix = stage.rstrip('&')
+                passes[prefix] = g._find_passes(prefix, listings)
+                for (npass, fns) in passes[prefix]:
+                    for fn in fns:
+                        argv[fn] = recorder.run(fn)
+                        n += 1
+            dirs[rel] = { 'mtime': os.stat(dirp).st_mtime, 'passes': passes, 'argv': argv }
+        self.clear()
+        self.update({ 'version': 1, 'rootdir': root, 'recursive': depth > 0, 'style': style, 'stages': stages,
+                      'walk': walk, 'dirs': dirs })
+        return n
+
+    def save(self, fn):
+        tmpfn = '%s.tmp' % (fn)
+        f = open(tmpfn, 'w')
+        try:
+            json.dump(self, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(tmpfn, fn)
+
+    def rootdir(self):
+        return self['rootdir']
+
+    def recursive(self):
+        return self['recursive']
+
+    def style(self):
+        '''returns the (name, stages) of the style the plan runs'''
+        return (self['style'], self['stages'])
+
+    def _rel(self, dirp):
+        rel = os.path.relpath(os.path.abspath(dirp), self['rootdir'])
+        return '' if rel == '.' else rel
+
+    def walk(self, root):
+        '''returns the planned subdirectories of `root` as Flow._walk does, without listing any directory'''
+        rel = self._rel(root)
+        if rel == '':
+            return [tuple(e) for e in self['walk']]
+        top = rel.count(os.sep) + 1
+        return [(d - top, os.path.relpath(p, rel)) for (d, p) in self['walk'] if p.startswith(rel + os.sep)]
+
+    def passes(self, dirp, prefix):
+        '''returns the planned (number, scripties) of each pass of the stage `prefix` in `dirp`, as Flow._find_passes does'''
+        d = self['dirs'].get(self._rel(dirp))
+        if d is None:
+            return []
+        return [(npass, fns) for (npass, fns) in d['passes'].get(prefix, [])]
+
+    def argv(self, dirp, fn):
+        '''returns the planned command line of `fn` in `dirp`, or None'''
+        return self['dirs'].get(self._rel(dirp), {}).get('argv', {}).get(fn)
+
+    def stale(self):
+        '''returns the planned directories that were removed, or whose entries changed, since the plan was compiled'''
+        changed = list()
+        for (rel, d) in sorted(self['dirs'].items()):
+            try:
+                if os.stat(os.path.join(self['rootdir'], rel)).st_mtime != d['mtime']:
+                    changed.append(rel)
+            except OSError, e:
+                changed.append(rel)
+        return changed
@@ -0,0 +1,184 @@
+'''
+Run reports: one record per scriptie execution and per directory flow, with timing and resource usage
+'''
+import csv
+import json
+import os
+import os.path
+import StringIO
+
+class FlowReport(object):
+    '''Appends one record per scriptie execution, and one per directory flow, to a JSON-lines file 
+    or to a CSV file if its name ends with .csv.
+    Each record is written with a single append, so concurrent threads and processes can share one report.'''
+
+    FIELDS = ['kind', 'dir', 'stage', 'pass', 'scriptie', 'interpreter', 'status',
+              'start', 'wall', 'utime', 'stime', 'maxrss_kb', 'worker']
+
+    def __init__(self, fn, truncate = True):
+        '''@param fn report filename
+        @param truncate starts a new report, rather than appending to an existing one
+        '''
+        super(FlowReport, self).__init__()
+        self._fn = os.path.abspath(fn)
+        self._csv = fn.lower().endswith('.csv')
+        if truncate:
+            f = open(self._fn, 'wb')
+            try:
+                if self._csv:
+                    csv.writer(f).writerow(self.FIELDS)
+            finally:
+                f.close()
+
+    def filename(self):
+        return self._fn
+
+    def append(self, record):
+        if self._csv:
+            buf = StringIO.StringIO()
+            csv.writer(buf).writerow([record.get(k) for k in self.FIELDS])
+            line = buf.getvalue()
+        else:
+            line = json.dumps(record, sort_keys=True) + '\n'
+        fd = os.open(self._fn, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+
+    def records(self):
+        '''returns a list of all records in the report'''
+        f = open(self._fn, 'rb')
+        try:
+            if self._csv:
+                rows = list(csv.DictReader(f))
+                for r in rows:
+                    for (k, t) in (('wall', float), ('utime', float), ('stime', float), ('start', float), 
+                                   ('status', int), ('maxrss_kb', int)):
+                        r[k] = t(r[k]) if r[k] != '' else None
+                return rows
+            return [json.loads(line) for line in f if line.strip() != '']
+        finally:
+            f.close()
+
+    def summary(self, top = 10):
+        '''returns a text summary of the `top` slowest scripties and the totals for each stage'''
+        records = [r for r in self.records() if r.get('kind', 'scriptie') == 'scriptie']
+        lines = ['Slowest %d of %d scripties:' % (min(top, len(records)), len(records))]
+        for r in sorted(records, key=lambda r: r['wall'], reverse=True)[0:top]:
+            lines.append('  %10.3fs  %s (status %d)' % (r['wall'], os.path.join(r['dir'] or '', r['scriptie']), r['status']))
+
+        stages = dict()
+        for r in records:
+            t = stages.setdefault(r['stage'], { 'n': 0, 'wall': 0.0, 'utime': 0.0, 'stime': 0.0, 'maxrss_kb': 0 })
+            t['n'] += 1
+            for k in ('wall', 'utime', 'stime'):
+                t[k] += r[k]
+            t['maxrss_kb'] = max(t['maxrss_kb'], r['maxrss_kb'])
+        lines.append('Totals by stage:')
+        for (stage, t) in sorted(stages.items(), key=lambda i: i[1]['wall'], reverse=True):
+            lines.append('  %-12s %5d scripties %10.3fs wall %10.3fs user %10.3fs sys %8d MB peak' %
+                         (stage, t['n'], t['wall'], t['utime'], t['stime'], t['maxrss_kb'] / 1024))
+        return '\n'.join(lines)
+
+class FlowProfile(object):
+    '''Reconstructs the timeline of a recursive run from the directory flow and scriptie records of a FlowReport'''
+
+    def __init__(self, records, nproc = 1):
+        '''@param records from FlowReport.records()
+        @param nproc number of concurrent directory flows the run was allowed
+        '''
+        super(FlowProfile, self).__init__()
+        self._nproc = max(nproc, 1)
+        self._flows = [r for r in records if r.get('kind') == 'flow']
+        self._scripties = [r for r in records if r.get('kind', 'scriptie') == 'scriptie']
+        self._root = min([r['dir'] for r in self._flows], key=len) if len(self._flows) > 0 else ''
+
+    def depth(self, d):
+        '''returns the depth of directory `d` below the root of the run'''
+        if d == self._root:
+            return 0
+        return len(os.path.relpath(d, self._root).split(os.sep))
+
+    def span(self):
+        if len(self._flows) == 0:
+            return 0.0
+        return max([r['start'] + r['wall'] for r in self._flows]) - min([r['start'] for r in self._flows])
+
+    def serial(self):
+        '''returns the time the run would take with one directory flow at a time'''
+        return sum([r['wall'] for r in self._flows])
+
+    def critical_path(self):
+        '''returns (seconds, [directories]) for the longest chain of directory flows that had to run one 
+        after another, since each directory waits for all of its subdirectories'''
+        walls = dict([(r['dir'], r['wall']) for r in self._flows])
+        children = dict()
+        for d in walls:
+            if d != self._root:
+                children.setdefault(os.path.dirname(d), []).append(d)
+
+        longest = dict()
+        for d in sorted(walls, key=self.depth, reverse=True): # deepest first
+            below = [longest[c] for c in children.get(d, [])]
+            (t, path) = max(below) if len(below) > 0 else (0.0, [])
+            longest[d] = (t + walls[d], path + [d])
+        if self._root not in longest:
+            return (0.0, [])
+        return longest[self._root]
+
+    def levels(self):
+        '''returns [(depth, flows, window, busy, idle)] for each level, deepest first, where idle is the 
+        worker-time left unused within the level's window'''
+        bylevel = dict()
+        for r in self._flows:
+            bylevel.setdefault(self.depth(r['dir']), []).append(r)
+
+        results = list()
+        for depth in sorted(bylevel, reverse=True):
+            t0 = min([r['start'] for r in bylevel[depth]])
+            t1 = max([r['start'] + r['wall'] for r in bylevel[depth]])
+            busy = sum([max(0.0, min(t1, r['start'] + r['wall']) - max(t0, r['start'])) for r in self._flows])
+            window = t1 - t0
+            results.append((depth, len(bylevel[depth]), window, busy, max(0.0, self._nproc * window - busy)))
+        return results
+
+    def summary(self):
+        span = self.span()
+        serial = self.serial()
+        lines = ['Profile of %d directory flows and %d scripties with %d workers:' % 
+                 (len(self._flows), len(self._scripties), self._nproc)]
+        if span > 0:
+            lines.append('  %10.3fs elapsed, %10.3fs serial, %.2fx speedup, %.0f%% parallel efficiency' % 
+                         (span, serial, serial / span, 100.0 * serial / (span * self._nproc)))
+        (t, path) = self.critical_path()
+        lines.append('  %10.3fs critical path through %d directories:' % (t, len(path)))
+        for d in path:
+            lines.append('                %s' % (d))
+        lines.append('  Level  Flows     Window       Busy       Idle')
+        for (depth, n, window, busy, idle) in self.levels():
+            lines.append('  %5d %6d %9.3fs %9.3fs %9.3fs' % (depth, n, window, busy, idle))
+        return '\n'.join(lines)
+
+    def write_trace(self, fn):
+        '''writes the timeline as a Chrome trace-format JSON file, with one track per worker'''
+        records = self._flows + self._scripties
+        t0 = min([r['start'] for r in records]) if len(records) > 0 else 0.0
+        tids = dict()
+        events = list()
+        for r in records:
+            tid = tids.setdefault(r.get('worker'), len(tids) + 1)
+            if r.get('kind') == 'flow':
+                (name, cat, args) = (r['dir'], 'flow', { 'status': r['status'] })
+            else:
+                (name, cat, args) = (r['scriptie'], r['stage'] or '', 
+                                     { 'dir': r['dir'], 'pass': r['pass'], 'status': r['status'], 'maxrss_kb': r['maxrss_kb'] })
+            events.append({ 'name': name, 'cat': cat, 'ph': 'X', 'pid': 1, 'tid': tid,
+                            'ts': int((r['start'] - t0) * 1e6), 'dur': int(r['wall'] * 1e6), 'args': args })
+        for (worker, tid) in tids.items():
+            events.append({ 'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': { 'name': worker } })
+        f = open(fn, 'w')
+        try:
+            json.dump({ 'traceEvents': events, 'displayTimeUnit': 'ms' }, f)
+        finally:
+            f.close()
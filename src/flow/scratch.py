@@ -0,0 +1,137 @@
+'''
+Local scratch staging: runs each directory flow in a copy on local disk or tmpfs, and copies back what it changed
+'''
+import hashlib
+import os
+import os.path
+import shutil
+import stat
+from multiprocessing.pool import ThreadPool
+
+from flow import _match_prefixes
+
+_bufsize = 1024 * 1024
+
+def _copy((src, dst)):
+    '''copies `src` onto `dst` through a temporary file, with `src`'s mode and times'''
+    tmp = '%s.flowtmp' % (dst)
+    fsrc = open(src, 'rb')
+    try:
+        fdst = open(tmp, 'wb')
+        try:
+            shutil.copyfileobj(fsrc, fdst, _bufsize)
+        finally:
+            fdst.close()
+    finally:
+        fsrc.close()
+    shutil.copystat(src, tmp)
+    os.rename(tmp, dst)
+
+class FlowScratch(object):
+    '''Runs the stages of each directory flow in a scratch copy of the directory under `scratchdir`, e.g., on
+    local disk or /dev/shm rather than NFS, and copies the new and changed files back once the stages finish
+    without an error. Files that the stages remove are not removed from the directory.
+    The directory's files are copied in parallel, while its subdirectories, and the files and folders that
+    the exclusions name (e.g., data, or _* and .*), are only symlinked, so reading or writing them reaches
+    the original. Scripties that refer to the directory's parent by a relative path do not work in scratch.
+    Supports FLOW_SCRATCH_KEEP ('never' (default), 'failed' or 'always'), which scratch copies to keep for
+    inspection, FLOW_SCRATCH_JOBS (default 8), the number of concurrent copies, and FLOW_SCRATCH_LINK,
+    which hard-links files into scratch where it can, for scripties that replace their files rather than
+    rewrite them, environment variables.'''
+    def __init__(self, scratchdir, excluded_dirs = [], excluded_prefix = [], keep = None, jobs = None, link = None):
+        '''@param scratchdir directory in which to make the scratch copies
+        @param excluded_dirs names of files and folders to symlink rather than copy
+        @param excluded_prefix prefixes of files and folders to symlink rather than copy
+        '''
+        super(FlowScratch, self).__init__()
+        self._scratchdir = os.path.abspath(scratchdir)
+        self._excluded_dirs = excluded_dirs
+        self._excluded_prefix = excluded_prefix
+        self._keep = keep if keep is not None else os.getenv('FLOW_SCRATCH_KEEP', 'never')
+        if self._keep not in ('never', 'failed', 'always'):
+            raise ValueError('FLOW_SCRATCH_KEEP must be never, failed or always, not %s' % (self._keep))
+        self._jobs = jobs if jobs is not None else int(os.getenv('FLOW_SCRATCH_JOBS', '8'))
+        self._link = link if link is not None else os.getenv('FLOW_SCRATCH_LINK', '') not in ('', '0')
+
+    def _copied(self, name):
+        return name not in self._excluded_dirs and not _match_prefixes(name, self._excluded_prefix)
+
+    def _map(self, f, items):
+        if len(items) < 2 or self._jobs < 2:
+            map(f, items)
+            return
+        pool = ThreadPool(min(self._jobs, len(items)))
+        try:
+            pool.map(f, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def path(self, dirp):
+        '''returns the scratch copy of `dirp`, which keeps its name so scripties see the same basename'''
+        dirp = os.path.abspath(dirp)
+        return os.path.join(self._scratchdir, 'flow-%s' % (hashlib.sha1(dirp).hexdigest()[0:16]), os.path.basename(dirp))
+
+    def stage(self, dirp):
+        '''Makes the scratch copy of `dirp`, returning its path and a manifest of what was copied'''
+        dirp = os.path.abspath(dirp)
+        workdir = self.path(dirp)
+        top = os.path.dirname(workdir)
+        if os.path.lexists(top): # left from an earlier run
+            shutil.rmtree(top)
+        os.makedirs(workdir)
+        copies = list()
+        for name in os.listdir(dirp):
+            src = os.path.join(dirp, name)
+            st = os.lstat(src)
+            if stat.S_ISREG(st.st_mode) and self._copied(name):
+                copies.append((src, os.path.join(workdir, name)))
+            else:
+                os.symlink(src, os.path.join(workdir, name))
+        if self._link:
+            for (src, dst) in list(copies):
+                try:
+                    os.link(src, dst)
+                    copies.remove((src, dst))
+                except OSError, e: # e.g., across filesystems
+                    pass
+        self._map(_copy, copies)
+        manifest = dict()
+        for name in os.listdir(workdir):
+            st = os.lstat(os.path.join(workdir, name))
+            manifest[name] = (st.st_size, st.st_mtime) if stat.S_ISREG(st.st_mode) else None # None for symlinks
+        return (workdir, manifest)
+
+    def sync(self, dirp, workdir, manifest):
+        '''Copies the files that are new or changed in `workdir` since stage() back into `dirp`, returning how many'''
+        dirp = os.path.abspath(dirp)
+        copies = list()
+        for (root, dirs, files) in os.walk(workdir):
+            rel = os.path.relpath(root, workdir)
+            dst = os.path.normpath(os.path.join(dirp, rel))
+            for name in dirs + files:
+                p = os.path.join(root, name)
+                q = os.path.join(dst, name)
+                st = os.lstat(p)
+                staged = manifest.get(name, False) if rel == '.' else False
+                if (staged is None and stat.S_ISLNK(st.st_mode)) or staged == (st.st_size, st.st_mtime):
+                    continue # still one of our symlinks, or an unchanged copy
+                if stat.S_ISLNK(st.st_mode):
+                    if os.path.lexists(q):
+                        os.unlink(q)
+                    os.symlink(os.readlink(p), q)
+                elif stat.S_ISDIR(st.st_mode):
+                    if not os.path.isdir(q):
+                        os.mkdir(q)
+                        shutil.copystat(p, q)
+                elif stat.S_ISREG(st.st_mode) and not (os.path.exists(q) and os.path.samefile(p, q)):
+                    copies.append((p, q))
+        self._map(_copy, copies)
+        return len(copies)
+
+    def cleanup(self, workdir, ok):
+        '''Removes the scratch copy unless the retention policy keeps it, returning whether it was kept'''
+        if self._keep == 'always' or (self._keep == 'failed' and not ok):
+            return True
+        shutil.rmtree(os.path.dirname(workdir), ignore_errors=True)
+        return False
@@ -3,15 +3,17 @@ Flow: A Swiss-army knife for scientific workflows using linear model
 '''
 
 import __init__ as flow
+from flow import _cancel
 import optparse
 import sys
 import os
 import json
 import signal
 
+# the cache, daemon, history, journal, logs, plan, report, scratch, ssh, warm and watch modules are imported only when their options are used, to keep startup fast
+
 try:
-    from commands import getoutput
-    _ncpu = int(getoutput("grep -c -e '^processor' /proc/cpuinfo"))
+    _ncpu = int(os.sysconf('SC_NPROCESSORS_ONLN'))
 except Exception, e:
     _ncpu = 4
 
@@ -20,12 +22,70 @@ try:
 except Exception, e:
     _maxdepth = 128
 
-signal.signal(signal.SIGINT, lambda signal, frame: sys.exit(-1))
-signal.signal(signal.SIGTERM, lambda signal, frame: sys.exit(-1))
+def _terminate(signum, frame):
+    '''stops the scripties of an interrupted flow, so that none are left running on their own, and the flows 
+    and scripties that have yet to start'''
+    _cancel()
+    sys.exit(128 + signum) # as shells report a signal, and not 255, which ssh uses for a failed connection
+
+signal.signal(signal.SIGINT, _terminate)
+signal.signal(signal.SIGTERM, _terminate)
 
 # setup static functions
+
+def _jobs(option, opt, value, parser):
+    '''-j takes an optional number of jobs, like make, and all CPUs without one'''
+    value = _ncpu
+    if len(parser.rargs) > 0 and parser.rargs[0].isdigit():
+        value = int(parser.rargs.pop(0))
+    setattr(parser.values, option.dest, value)
+
+def _remote_args(options):
+    '''returns the flow options for running each directory flow of a recursive run on its own, e.g., over ssh'''
+    args = list()
+    for (on, flag) in ((options.quiet, '-q'), (options.dryrun, '-n'), (not options.keep_going, '-K'), 
+                       (not options.numbered, '-N'), (options.incremental, '--incremental'), (options.force, '--force'),
+                       (options.logs, '--logs'), (options.warm_python, '--warm-python')):
+        if on:
+            args.append(flag)
+    for stage in options.invalidated:
+        args.extend(['--invalidate', stage])
+    for (value, flag) in ((options.task, '-t'), (options.sql_batch, '--sql-batch'), (options.load, '-l'), (options.memfree, '--mem-free')):
+        if value is not None and value != '':
+            args.extend([flag, str(value)])
+    for (values, flag) in ((options.excluded_dirs, '--exclude'), (options.excluded_prefix, '--exclude-prefix')):
+        for value in values:
+            args.extend([flag, value])
+    for (stage, n) in sorted(options.weights.items()):
+        args.extend(['--weight', '%s=%d' % (stage, n)])
+    for (stage, n) in sorted(options.threads.items()):
+        args.extend(['--threads', '%s=%d' % (stage, n) if stage is not None else str(n)])
+    if options.pin:
+        args.append('--pin')
+    for (value, flag) in ((options.cache, '--cache'), (options.scratch, '--scratch')): # shared by all directories
+        if value is not None and value != '':
+            args.extend([flag, os.path.abspath(value)])
+    args.extend(['--stage-jobs', str(options.stage_jobs)])
+    return args
+
+def _weight(option, opt, value, parser):
+    '''parses STAGE=N into the dict of stage weights'''
+    try:
+        (stage, n) = value.split('=', 1)
+        getattr(parser.values, option.dest)[stage.strip()] = int(n)
+    except ValueError, e:
+        raise optparse.OptionValueError('%s requires STAGE=N, not "%s"' % (opt, value))
     
+def _threads(option, opt, value, parser):
+    '''parses N, or STAGE=N, into the dict of stage (or None for every stage) threads'''
+    try:
+        (stage, sep, n) = value.rpartition('=')
+        getattr(parser.values, option.dest)[stage.strip() if sep != '' else None] = int(n)
+    except ValueError, e:
+        raise optparse.OptionValueError('%s requires N or STAGE=N, not "%s"' % (opt, value))
+
 def main(commandargs = sys.argv):
+    (styles, languages) = flow.registry()
     parser = optparse.OptionParser(prog = "flow", formatter=optparse.IndentedHelpFormatter(width=os.getenv('COLUMNS', 132)), version=flow.__version__)
     parser.add_option("-q", "--quiet",
                       action="store_true", dest="quiet", default=False,
@@ -47,20 +107,47 @@ def main(commandargs = sys.argv):
                       help="Keep going when scripties exit with error (default: Yes)")
     parser.add_option("-K", "--not-keep-going",
                       action="store_false", dest="keep_going", default=True,
-                      help="Turns off -k (default: No).")
+                      help="Turns off -k, and stops every running scriptie at the first error (default: No).")
 
     parser.add_option("-N", "--ignore-numbers",
                       action="store_false", dest="numbered", default=True,
                       help="suppress running numbered files (default: No)")
-    parser.add_option("-j",
-                      action="store_const", dest="jobs", const=_ncpu, default=1,
-                      help="flow with up to %s concurrent jobs (default: 1)" % (_ncpu))
+    parser.add_option("-j", "--jobs",
+                      action="callback", callback=_jobs, dest="jobs", default=1,
+                      help="flow with up to N concurrent jobs, or %s with no N (default: 1)" % (_ncpu))
+    parser.add_option("-l", "--load-average", metavar="LOAD", type="float",
+                      action="store", dest="load", default=None,
+                      help="start no new flows or scripties while the load average is at least LOAD, unless nothing is running (default: no limit)")
+    parser.add_option("--mem-free", metavar="MB", type="int",
+                      action="store", dest="memfree", default=None,
+                      help="start no new flows or scripties while less than MB megabytes of memory are available, unless nothing is running (default: no limit)")
+    parser.add_option("--weight", metavar="STAGE=N", type="string",
+                      action="callback", callback=_weight, dest="weights", default={},
+                      help="scripties of STAGE take N of the -j job slots, e.g. --weight model=4 (default: 1)")
+    parser.add_option("--threads", metavar="[STAGE=]N", type="string",
+                      action="callback", callback=_threads, dest="threads", default={},
+                      help="let each scriptie, or those of STAGE, start N threads, and count it as its share of the -j job slots (default: the CPUs divided by -j, with -j; 0 to leave OMP_NUM_THREADS and the like alone)")
+    parser.add_option("--pin",
+                      action="store_true", dest="pin", default=False,
+                      help="with -j, pin each scriptie to as many CPUs of its own as it has threads (default: No)")
+    parser.add_option("--executor", metavar="NAME",
+                      action="store", dest="executor", default='thread', choices=['thread', 'process', 'ssh'],
+                      help="run concurrent flows in a pool of 'thread' or 'process' workers, or on the --hosts over 'ssh' (default: thread)")
+    parser.add_option("--hosts", metavar="HOSTS",
+                      action="store", dest="hosts", default=os.getenv('FLOW_HOSTS'),
+                      help="with --executor ssh, run directory flows on HOSTS (e.g., \"node1:8,node2:16,local:4\") with up to the given number of flows on each, where \"local\" is this machine; see also FLOW_HOSTS, FLOW_SSH and FLOW_REMOTE_COMMAND")
+    parser.add_option("--max-procs", metavar="N", type="int",
+                      action="store", dest="max_procs", default=None,
+                      help="run at most N scriptie processes at once across all flows; see also FLOW_PROC_LIMITS (default: no limit)")
+    parser.add_option("--stage-jobs", metavar="N", type="int",
+                      action="store", dest="stage_jobs", default=_ncpu,
+                      help="run up to N numbered passes at once in stages marked with '&', e.g. FLOW_STYLE_DEFAULT=\"setup,download&,model\" (default: %s)" % (_ncpu))
     parser.add_option("-i",
                       action="store_true", dest="interactive", default=False,
                       help="flow with interactive confirmations (default: No)")
     parser.add_option("-s", "--style", metavar="STYLE",
                       action="store", dest="style", default=None,
-                      help="flow with style (styles are %s)" % ', '.join(sorted(flow.Flow()._styles.keys())))
+                      help="flow with style (styles are %s)" % ', '.join(sorted(styles.keys())))
     parser.add_option("-t", "--task", metavar="TASK",
                       action="store", dest="task", default=None,
                       help="flow with single task")
@@ -70,12 +157,91 @@ def main(commandargs = sys.argv):
     parser.add_option("--exclude-prefix", metavar="PREFIX",
                       action="append", dest="excluded_prefix", default=['.', '_'],
                       help="exclude files/folders starting with PREFIX (default: .*, _*)")
+    parser.add_option("--index",
+                      action="store_true", dest="index", default=False,
+                      help="with -r, cache directory listings in .flowindex and only list directories that changed (default: No)")
+    parser.add_option("--incremental",
+                      action="store_true", dest="incremental", default=False,
+                      help="skip scripties that are unchanged since their last successful run (default: No)")
+    parser.add_option("--force",
+                      action="store_true", dest="force", default=False,
+                      help="with --incremental, run every scriptie anyway and refresh its state (default: No)")
+    parser.add_option("--invalidate", metavar="STAGE",
+                      action="append", dest="invalidated", default=[],
+                      help="with --incremental, run STAGE again along with every later stage")
+    parser.add_option("--logs",
+                      action="store_true", dest="logs", default=False,
+                      help="capture scriptie output in _logs/STAGE.stdout.log and _logs/STAGE.stderr.log in each directory, and prefix console output with directory and stage (default: No)")
+    parser.add_option("--sql-batch", metavar="SCOPE",
+                      action="store", dest="sql_batch", default=None, choices=['stage', 'style'],
+                      help="run the SQL scripties of each 'stage', or of the whole 'style', in one SQL_SHELL session that stops at the first error; e.g., SQL_SHELL=sqlite3 SQL_FLAGS=test.db (default: one session per scriptie)")
+    parser.add_option("--warm-python",
+                      action="store_true", dest="warm_python", default=False,
+                      help="run python scripties in pre-started PYTHON workers that have already imported FLOW_PYTHON_PRELOAD (e.g., \"numpy,pandas\"), except with --logs (default: No)")
+    parser.add_option("--scratch", metavar="DIR",
+                      action="store", dest="scratch", default=None,
+                      help="run each directory flow in a copy in DIR (e.g., on local disk or /dev/shm), and copy new and changed files back when it succeeds")
+    parser.add_option("--cache", metavar="DIR",
+                      action="store", dest="cache", default=os.getenv('FLOW_CACHE_DIR'),
+                      help="restore the outputs of scripties that declare them (e.g., \"# flow-outputs: _results.txt\") from DIR when their content and declared inputs are unchanged, and cache them there otherwise; see also FLOW_CACHE_DIR and FLOW_CACHE_MAXBYTES")
+    parser.add_option("--report", metavar="FILE",
+                      action="store", dest="report", default=None,
+                      help="record the time and resources used by each scriptie in FILE as JSON lines, or CSV if FILE ends with .csv")
+    parser.add_option("--report-top", metavar="N", type="int",
+                      action="store", dest="report_top", default=10,
+                      help="with --report, summarize the N slowest scripties when done (default: 10)")
+    parser.add_option("--profile", metavar="FILE",
+                      action="store", dest="profile", default=None,
+                      help="analyze the critical path and parallel efficiency of the run, and write its timeline to FILE in Chrome trace format")
+    parser.add_option("--history",
+                      action="store_true", dest="history", default=False,
+                      help="record how long each directory flow takes in .flowhistory, start the longest first, and estimate the time left (default: No)")
+    parser.add_option("--journal", metavar="FILE",
+                      action="store", dest="journal", default=None,
+                      help="record each directory flow and scriptie as it starts and finishes in FILE, so an interrupted run can --resume")
+    parser.add_option("--resume",
+                      action="store_true", dest="resume", default=False,
+                      help="skip the directory flows and scripties that the --journal (default: .flowjournal in the top directory) records as finished successfully, and keep journaling (default: No)")
+    parser.add_option("--plan", metavar="FILE",
+                      action="store", dest="plan", default=None,
+                      help="write the directories, scripties and command lines that the flow would run to FILE, without running them")
+    parser.add_option("--execute", metavar="FILE",
+                      action="store", dest="execute", default=None,
+                      help="run the plan in FILE from --plan, without listing any directories; the plan sets the top directory, style and -r")
+    parser.add_option("--check-plan",
+                      action="store_true", dest="check_plan", default=False,
+                      help="with --execute, refuse to run if any directory in the plan changed since it was written (default: No)")
+    parser.add_option("--watch",
+                      action="store_true", dest="watch", default=False,
+                      help="after running, watch for changed files and run again the directory flows they are in, and their parent directories' (default: No)")
+    parser.add_option("--daemon", metavar="SOCKET",
+                      action="store", dest="daemon", default=None,
+                      help="serve flow commands on the Unix socket SOCKET, for flows run with FLOW_DAEMON=SOCKET")
     parser.add_option("--flows",
                       action="store_true", dest="listflows", default=False,
                       help="print list of flow styles and languages supported")
     
-    # parse command-line options
-    (options, args) = parser.parse_args(commandargs)
+    # parse command-line options, splitting -j8 and --jobs=8 into -j 8 since -j takes an optional number
+    argv = list()
+    for a in commandargs:
+        if len(a) > 2 and a.startswith('-j') and a[2:].isdigit():
+            argv.extend(['-j', a[2:]])
+        elif a.startswith('--jobs='):
+            argv.extend(['-j', a[len('--jobs='):]])
+        else:
+            argv.append(a)
+    (options, args) = parser.parse_args(argv)
+
+    # hand off to a flow daemon, or become one
+    if options.daemon is not None:
+        import daemon
+        daemon.serve(options.daemon, main)
+        sys.exit(0)
+    if os.getenv('FLOW_DAEMON', '') != '' and not options.interactive:
+        import daemon
+        status = daemon.request(os.getenv('FLOW_DAEMON'), commandargs)
+        if status is not None:
+            sys.exit(status)
 
     # verify command-line options
     if options.style is not None and options.style.startswith('-'):
@@ -94,36 +260,185 @@ def main(commandargs = sys.argv):
 
     assert options.style is not None
 
-    if options.style not in flow.Flow()._styles:
+    if options.style not in styles:
         parser.error('''ERROR: Style "%s" is not registered.''' % (options.style))
 
+    if options.force or len(options.invalidated) > 0:
+        options.incremental = True
+
+    if options.executor == 'ssh' and (options.hosts is None or options.hosts.strip() == ''):
+        parser.error('''ERROR: --executor ssh requires --hosts.''')
+    if options.plan is not None and options.execute is not None:
+        parser.error('''ERROR: Cannot use --plan and --execute concurrently.''')
+    if options.execute is not None and (options.watch or options.executor == 'ssh'):
+        parser.error('''ERROR: --execute cannot be used with --watch or --executor ssh, which list directories.''')
+
     # check for special behaviors
     if options.listflows:
         print json.dumps({ 
-            'flow-styles': flow.Flow()._styles, 
-            'flow-languages': flow.Flow()._languages}, 
+            'flow-styles': styles, 
+            'flow-languages': languages}, 
             indent=2, sort_keys=True)
         sys.exit(0)
 
-    f = flow.Flow(os.getcwd() if options.srcdir == '.' else options.srcdir, 
+    report = None
+    if options.report is not None or options.profile is not None:
+        from report import FlowReport, FlowProfile
+    if options.report is not None:
+        report = FlowReport(options.report)
+    elif options.profile is not None:
+        import tempfile
+        (fd, tmpfn) = tempfile.mkstemp(prefix='flow-', suffix='.json')
+        os.close(fd)
+        report = FlowReport(tmpfn)
+
+    logs = None
+    if options.logs:
+        from logs import FlowLogs
+        logs = FlowLogs()
+
+    rootdir = os.getcwd() if options.srcdir == '.' else options.srcdir
+
+    plan = None
+    if options.execute is not None:
+        from plan import FlowPlan
+        plan = FlowPlan(options.execute)
+        rootdir = plan.rootdir()
+        options.recursive = plan.recursive()
+        stale = plan.stale() if options.check_plan else []
+        if len(stale) > 0:
+            print >>sys.stderr, 'ERROR: The plan in %s is stale, since these directories changed: %s' % (options.execute, ' '.join([d or '.' for d in stale]))
+            sys.exit(1)
+
+    history = None
+    if options.history and not options.dryrun:
+        from history import FlowHistory
+        history = FlowHistory(os.path.join(rootdir, '.flowhistory'))
+
+    journal = None
+    if options.resume and options.journal is None:
+        options.journal = os.path.join(rootdir, '.flowjournal')
+    if options.journal is not None and (options.resume or not options.dryrun):
+        from journal import FlowJournal
+        journal = FlowJournal(options.journal, resume=options.resume)
+
+    cache = None
+    if options.cache is not None and options.cache != '':
+        from cache import FlowCache
+        cache = FlowCache(options.cache)
+
+    scratch = None
+    if options.scratch is not None and options.scratch != '':
+        from scratch import FlowScratch
+        scratch = FlowScratch(options.scratch, options.excluded_dirs, options.excluded_prefix)
+
+    warm = None
+    if options.warm_python and not (options.dryrun or options.interactive):
+        from warm import FlowWarmPython
+        warm = FlowWarmPython(workers=options.jobs if options.executor == 'thread' else 1) # the top directory's, otherwise
+
+    cpus = None
+    if (options.jobs > 1 or len(options.threads) > 0) and options.threads.get(None) != 0:
+        cpus = flow.FlowCPUs(options.jobs, threads=options.threads, pin=options.pin)
+    weights = dict(options.weights) # and not in options, as remote flows work out their own
+    if cpus is not None:
+        for (stage, n) in cpus.weights().items():
+            weights.setdefault(stage, n) # a stage with more threads runs fewer at once
+
+    admission = None
+    if options.load is not None or options.memfree is not None or len(weights) > 0:
+        admission = flow.FlowAdmission(options.jobs if options.jobs > 1 else options.stage_jobs, 
+                                       load=options.load, memfree=options.memfree, weights=weights)
+
+    runner = None
+    if options.max_procs is not None or os.getenv('FLOW_PROC_LIMITS', '') != '' or admission is not None:
+        runner = flow.ThrottledFlowExecution(options.dryrun, options.quiet, options.interactive, options.keep_going,
+                                             report=report, logs=logs, maxprocs=options.max_procs, admission=admission, cache=cache, warm=warm, journal=journal, cpus=cpus)
+
+    f = flow.Flow(rootdir, 
              dryrun=options.dryrun, 
              interactive=options.interactive,
              quiet=options.quiet,
              numbered=options.numbered,
              style=options.style,
+             runner=runner,
              keep_going=options.keep_going,
+             report=report,
+             logs=logs,
+             cache=cache,
+             warm=warm,
+             journal=journal,
+             cpus=cpus,
              excluded_dirs=options.excluded_dirs,
-             excluded_prefix=options.excluded_prefix)
+             excluded_prefix=options.excluded_prefix,
+             incremental=options.incremental,
+             force=options.force,
+             invalidated=options.invalidated,
+             stage_jobs=options.stage_jobs,
+             executor=options.executor,
+             index=options.index,
+             admission=admission,
+             sql_batch=options.sql_batch,
+             history=history,
+             plan=plan,
+             scratch=scratch)
 
     if options.task is not None:
         f.styles('task', [options.task])
         f.style('task')
+    if plan is not None:
+        (style, stages) = plan.style()
+        f.styles(style, stages)
+        f.style(style)
+
+    if options.plan is not None:
+        from plan import FlowPlan
+        plan = FlowPlan()
+        n = plan.compile(f, _maxdepth if options.recursive else 0)
+        plan.save(options.plan)
+        if not options.quiet:
+            print >>sys.stderr, 'Wrote a plan of %d directories and %d scripties to %s' % (len(plan['dirs']), n, options.plan)
+        sys.exit(0)
 
     if options.jobs > 1 and options.interactive:
         parser.error('ERROR: Flow cannot run with both -i and -j flags on.')
+    if options.watch and options.resume:
+        parser.error('ERROR: Flow cannot run with both --watch and --resume flags on.')
+
+    pool = None
+    if options.executor == 'ssh':
+        from ssh import FlowSSHPool, parse_hosts
+        pool = FlowSSHPool(parse_hosts(options.hosts), _remote_args(options), report, journal if not options.dryrun else None)
+        options.jobs = pool.nproc()
 
-    f.run(depth=_maxdepth if options.recursive else 0, 
-          nproc=options.jobs)
+    try:
+        if options.watch:
+            from watch import FlowWatcher
+            FlowWatcher(f, options.recursive).watch(depth=_maxdepth if options.recursive else 0,
+                                                    nproc=options.jobs,
+                                                    pool=pool)
+        else:
+            f.run(depth=_maxdepth if options.recursive else 0, 
+                  nproc=options.jobs,
+                  pool=pool)
+    finally:
+        if pool is not None:
+            pool.close()
+        if warm is not None:
+            warm.close()
+        if journal is not None:
+            journal.close()
+        if history is not None:
+            history.close()
+        if options.report is not None and not options.quiet:
+            print >>sys.stderr, report.summary(options.report_top)
+        if options.profile is not None:
+            profile = FlowProfile(report.records(), options.jobs)
+            profile.write_trace(options.profile)
+            if not options.quiet:
+                print >>sys.stderr, profile.summary()
+            if options.report is None:
+                os.unlink(report.filename())
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,154 @@
+'''
+Runs directory flows on other hosts over ssh, for trees on a filesystem that every host shares
+'''
+from multiprocessing.pool import ThreadPool
+import os
+import os.path
+import pipes
+import Queue
+import subprocess
+import sys
+import time
+
+from flow import _cancelled, _register, _setpgid
+
+# besides FLOW_* and SQL_*, the environment variables that choose interpreters on the remote host
+_forwarded = ('PERL', 'RUBY', 'PYTHON', 'R_FLAGS', 'LATEX_SHELL')
+
+def parse_hosts(s):
+    '''returns [(host, slots)] for "host1:4,host2:8,host3", where slots default to 1'''
+    hosts = list()
+    for h in [h.strip() for h in s.split(',') if h.strip() != '']:
+        (host, sep, n) = h.partition(':')
+        hosts.append((host, int(n) if sep != '' else 1))
+    return hosts
+
+class FlowSSHPool(object):
+    '''A pool of directory flows that runs each flow as `cd DIR && flow -s STYLE ...` on one of several hosts,
+    with up to its number of slots at once on each host. It has the same interface as FlowPool, and so can be
+    passed as the `pool` of Flow.run.
+    A flow that fails with ssh's exit status 255 is retried on another host, and its host gets no more flows.
+    The host "local" runs flows on this machine, without ssh. Each flow gets its host's number of slots as -j,
+    by which it splits the host's CPUs and job slots. The ssh processes are terminated along with
+    scripties, e.g., when a flow fails with -K, and each remote flow is terminated when its ssh connection closes.
+    Supports FLOW_SSH (default 'ssh') and FLOW_REMOTE_COMMAND (default 'flow') environment variables, and
+    passes FLOW_*, SQL_* and interpreter environment variables on to the remote flows.'''
+    def __init__(self, hosts, args = None, report = None, journal = None):
+        '''@param hosts list of (host, slots)
+        @param args list of flow options for each remote flow (e.g., ['-q', '--incremental'], or ['-t', 'doit'] instead of the style)
+        @param report a FlowReport that receives the timing, status and host of every directory flow
+        @param journal a FlowJournal into which the journal of every remote flow is merged when it ends
+        '''
+        super(FlowSSHPool, self).__init__()
+        self._args = args if args is not None else []
+        self._report = report
+        self._journal = journal
+        self._ssh = os.getenv('FLOW_SSH', 'ssh').split()
+        self._flow = os.getenv('FLOW_REMOTE_COMMAND', 'flow')
+        self._hosts = set([h for (h, n) in hosts])
+        self._nslots = dict(hosts)
+        self._down = set()
+        self._slots = Queue.Queue()
+        for (h, n) in hosts:
+            for i in xrange(n):
+                self._slots.put(h)
+        self._nproc = self._slots.qsize()
+        self._pool = ThreadPool(max(self._nproc, 1))
+
+    def nproc(self):
+        return self._nproc
+
+    def submit(self, rootdir, style, key, callback):
+        '''Runs the flow for `rootdir` with `style` on a free host, then calls `callback((key, exception or None))`'''
+        self._pool.apply_async(self._run, (rootdir, style, key), callback=callback)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self):
+        self._pool.terminate()
+        self._pool.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is not None: # e.g., interrupted, so the queued flows must not run
+            self.terminate()
+        else:
+            self.close()
+
+    def _command(self, host, rootdir, style, journal = None):
+        env = ['%s=%s' % (k, v) for (k, v) in sorted(os.environ.items())
+               if (k.startswith('FLOW_') and k != 'FLOW_DAEMON') or k.startswith('SQL_') or k in _forwarded]
+        argv = (['env'] + env if len(env) > 0 else []) + [self._flow] + (['-s', style] if '-t' not in self._args else []) + self._args
+        if self._nslots.get(host, 1) > 1:
+            argv += ['-j', str(self._nslots[host])]
+        if journal is not None:
+            argv += ['--journal', journal, '--resume']
+        (dirp, argv) = (pipes.quote(os.path.abspath(rootdir)), ' '.join([pipes.quote(a) for a in argv]))
+        if host == 'local':
+            return ['sh', '-c', 'cd %s && %s' % (dirp, argv)]
+        # a remote flow outlives its ssh process, so a watcher terminates it, which stops its scripties, once its 
+        # stdin ends, as it does when the connection closes
+        cmd = ('cd %s && exec 3<&0 && { %s </dev/null & p=$!; { cat; kill -TERM $p; } <&3 >/dev/null 2>&1 & w=$!; '
+               'exec 3<&-; wait $p; s=$?; kill $w 2>/dev/null; exit $s; }') % (dirp, argv)
+        return self._ssh + [host, 'sh -c %s' % (pipes.quote(cmd))] # whatever the login shell
+
+    def _acquire(self):
+        '''returns a free slot's host, or None once every host is down'''
+        while True:
+            try:
+                host = self._slots.get(True, 1.0)
+            except Queue.Empty:
+                if self._down == self._hosts:
+                    return None
+                continue
+            if host not in self._down:
+                return host # otherwise drop the slot of a host that failed
+
+    def _call(self, cmd):
+        '''runs `cmd` in its own process group, which terminate_children() reaches, returning its exit status'''
+        p = None
+        try:
+            p = subprocess.Popen(cmd, stdin=subprocess.PIPE, preexec_fn=_setpgid) # never written, only closed
+            _register(p.pid)
+            return p.wait()
+        finally:
+            if p is not None:
+                _register(p.pid, False)
+                p.stdin.close()
+
+    def _run(self, rootdir, style, key):
+        try:
+            start = time.time()
+            while True:
+                host = self._acquire()
+                if host is None:
+                    return (key, RuntimeError('No hosts left to run the flow for %s' % (rootdir)))
+                if _cancelled.is_set():
+                    self._slots.put(host)
+                    return (key, RuntimeError('Cancelled the flow for %s after an earlier failure' % (rootdir)))
+                journal = self._journal.extract(rootdir) if self._journal is not None else None
+                cmd = self._command(host, rootdir, style, journal)
+                try:
+                    status = self._call(cmd)
+                finally:
+                    if journal is not None:
+                        self._journal.merge(journal)
+                if status != 255 or host == 'local' or _cancelled.is_set(): # not a failed host, but a flow cut short
+                    self._slots.put(host)
+                    break
+                print >>sys.stderr, 'ERROR: Host %s failed, so it gets no more flows. Retrying %s on another host.' % (host, rootdir)
+                self._down.add(host)
+
+            if self._report is not None:
+                self._report.append({ 'kind': 'flow', 'dir': os.path.abspath(rootdir), 'stage': style,
+                                      'status': status, 'start': round(start, 3),
+                                      'wall': round(time.time() - start, 3), 'worker': host })
+            if status != 0:
+                return (key, subprocess.CalledProcessError(status, cmd))
+            return (key, None)
+        except Exception, e: # the scheduler must always hear back
+            return (key, e)
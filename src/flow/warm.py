@@ -0,0 +1,268 @@
+'''
+Warm Python workers: pre-started interpreters with preloaded modules that fork a child for each python scriptie.
+
+This file is also the worker itself, run as `python warm.py FD [MODULE...]` by whichever interpreter
+PYTHON names, and so it must work under both python 2 and 3.
+'''
+import collections
+import fcntl
+import json
+import os
+import os.path
+import runpy
+import signal
+import subprocess
+import sys
+import threading
+import traceback
+
+_usage = collections.namedtuple('_usage', ['ru_utime', 'ru_stime', 'ru_maxrss'])
+_fork_lock = threading.Lock() # for a forked process executor to start workers of its own
+
+def _retry(f, *args):
+    '''calls `f` again when a signal interrupts it, which python 2 raises as an error rather than retrying'''
+    while True:
+        try:
+            return f(*args)
+        except (IOError, OSError) as e:
+            if e.errno != 4: # EINTR
+                raise
+
+def _cloexec(fd, on = True):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    fcntl.fcntl(fd, fcntl.F_SETFD, (flags | fcntl.FD_CLOEXEC) if on else (flags & ~fcntl.FD_CLOEXEC))
+
+class FlowWarmPython(object):
+    '''A pool of warm workers for python scripties, which starts with `workers` interpreters and grows to as many
+    workers as scripties run at once. Each process executor starts its own when its first python scriptie runs.
+    Each scriptie runs in a child forked from a worker, in a fresh runpy namespace with its own cwd, argv,
+    stdin, stdout and stderr, so it sees the preloaded modules already imported but cannot change the worker.
+    Supports the PYTHON and FLOW_PYTHON_PRELOAD (e.g., "numpy,pandas") environment variables.'''
+    def __init__(self, python = None, preload = None, workers = 1):
+        '''@param python interpreter for the workers (default: PYTHON, or 'python')
+        @param preload list of modules that each worker imports when it starts
+        @param workers number of workers to start right away, so that they are warm by the first python scriptie
+        '''
+        super(FlowWarmPython, self).__init__()
+        self._python = python if python is not None else os.getenv('PYTHON', 'python')
+        if preload is None:
+            preload = [m.strip() for m in os.getenv('FLOW_PYTHON_PRELOAD', '').split(',') if m.strip() != '']
+        self._preload = preload
+        self._init_workers()
+        self._idle.extend([self._start() for i in range(workers)])
+
+    def _init_workers(self):
+        self._lock = threading.Lock()
+        self._idle = list()
+        self._busy = set()
+        self._pid = os.getpid() # whose workers these are
+
+    def __getstate__(self):
+        '''workers cannot be pickled, so each process executor starts its own'''
+        d = dict(self.__dict__)
+        del d['_lock']
+        del d['_idle']
+        del d['_busy']
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._init_workers()
+
+    def handles(self, cmdarray, inputfn):
+        '''True for `python scriptie` command lines whose stdin is not the console, which the workers need'''
+        return len(cmdarray) == 2 and cmdarray[0] == self._python and inputfn not in (None, '-')
+
+    def _start(self):
+        (r, w) = os.pipe() # for replies, since the worker's stdout is the console
+        _cloexec(r)
+        _cloexec(w)
+        try:
+            p = subprocess.Popen([self._python, os.path.splitext(os.path.abspath(__file__))[0] + '.py', str(w)] + self._preload,
+                                 stdin=subprocess.PIPE, preexec_fn=lambda: _cloexec(w, False))
+        finally:
+            os.close(w)
+        _cloexec(p.stdin.fileno())
+        p.replies = os.fdopen(r, 'r')
+        p.child = None # the process group of the scriptie it is running
+        return p
+
+    def call(self, cmdarray, inputfn, outputfn, logfn, cwd, env = None):
+        '''Runs `cmdarray` in a warm worker, returning its exit status (negative for a signal) and resource usage,
+        like FlowExecution._call. `outputfn` and `logfn` of '-' or None are the console. 
+        Of `env`, only the variables that differ from this process's environment reach the scriptie, and
+        variables that preloaded modules read when imported (e.g., OMP_NUM_THREADS) have no effect.
+        The scriptie runs in a process group of its own, which terminate_children() reaches.'''
+        from flow import _cancelled, _register # here, since the workers themselves may be python 3
+        if self._pid != os.getpid(): # a forked process executor, whose inherited workers are its parent's
+            with _fork_lock:
+                if self._pid != os.getpid():
+                    self._init_workers()
+        with self._lock:
+            p = self._idle.pop() if len(self._idle) > 0 else None
+        if p is None:
+            p = self._start()
+        with self._lock:
+            self._busy.add(p)
+        path = lambda fn: os.path.abspath(fn) if fn not in (None, '-') else None
+        changed = dict([(k, v) for (k, v) in (env or {}).items() if os.environ.get(k) != v])
+        try:
+            p.stdin.write((json.dumps({ 'cwd': os.path.abspath(cwd or '.'), 'argv': cmdarray[1:], 'env': changed,
+                                        'stdin': path(inputfn), 'stdout': path(outputfn), 'stderr': path(logfn) }) + '\n').encode('utf-8'))
+            p.stdin.flush()
+            p.child = json.loads(_retry(p.replies.readline))['pid']
+            _register(p.child)
+            try:
+                if _cancelled.is_set(): # cancelled while it started, after terminate_children() looked
+                    self._kill(p)
+                r = json.loads(_retry(p.replies.readline))
+            finally:
+                _register(p.child, False)
+                p.child = None
+        except (IOError, ValueError, KeyError) as e: # the worker died, so the scriptie did too
+            self._stop(p)
+            return (1, _usage(0.0, 0.0, 0))
+        with self._lock:
+            self._busy.discard(p)
+            self._idle.append(p)
+        return (r['status'], _usage(r['utime'], r['stime'], r['maxrss']))
+
+    def _kill(self, p):
+        '''terminates the scriptie that `p` is running, if any'''
+        if p.child is not None:
+            try:
+                os.killpg(p.child, signal.SIGTERM)
+            except OSError as e: # already gone
+                pass
+
+    def _stop(self, p):
+        with self._lock:
+            self._busy.discard(p)
+        try:
+            p.stdin.close()
+        except IOError as e:
+            pass
+        p.replies.close()
+        if p.poll() is None:
+            p.terminate()
+        p.wait()
+
+    def close(self):
+        '''stops all workers, along with the scripties of those that are busy'''
+        with self._lock:
+            (idle, busy, self._idle, self._busy) = (self._idle, list(self._busy), list(), set())
+        for p in busy: # their callers, if any are still waiting, see the worker die
+            self._kill(p)
+            if p.poll() is None:
+                p.terminate()
+            p.wait()
+        for p in idle:
+            self._stop(p)
+
+# Worker ------------------------------------------------------
+
+def _native(s):
+    '''str for a decoded JSON string, which is unicode in python 2'''
+    return s if isinstance(s, str) else s.encode('utf-8')
+
+def _child(request):
+    '''runs one scriptie in this forked child, returning its exit status'''
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    os.chdir(_native(request['cwd']))
+    for (k, v) in request.get('env', {}).items():
+        os.environ[_native(k)] = _native(v)
+    for (fd, key, mode) in ((0, 'stdin', os.O_RDONLY), (1, 'stdout', os.O_WRONLY | os.O_CREAT | os.O_TRUNC),
+                            (2, 'stderr', os.O_WRONLY | os.O_CREAT | os.O_APPEND)):
+        if request[key] is not None:
+            os.dup2(os.open(_native(request[key]), mode, 438), fd) # 0666
+    sys.argv = [_native(a) for a in request['argv']]
+    fn = sys.argv[0]
+    sys.path.insert(0, os.path.dirname(os.path.abspath(fn)))
+    try:
+        runpy.run_path(fn, run_name='__main__')
+        return 0
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        if isinstance(e.code, int):
+            return e.code & 0xff
+        sys.stderr.write('%s\n' % (e.code))
+        return 1
+    except BaseException as e:
+        (t, v, tb) = sys.exc_info()
+        while tb is not None and tb.tb_frame.f_code.co_filename != fn: # as if the scriptie ran on its own
+            tb = tb.tb_next
+        traceback.print_exception(t, v, tb if tb is not None else sys.exc_info()[2])
+        return 1
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+def _wait(pid):
+    while True:
+        try:
+            return os.wait4(pid, 0)
+        except OSError as e:
+            if e.errno != 4: # EINTR
+                raise
+
+def _reply(replies, r):
+    '''returns False if flow is gone'''
+    try:
+        replies.write(json.dumps(r) + '\n')
+        replies.flush()
+        return True
+    except (IOError, OSError) as e:
+        return False
+
+def main(argv):
+    running = [None] # the scriptie's process group, which signals to the worker's own group do not reach
+    def stop(signum, frame):
+        try:
+            if running[0] is not None:
+                os.killpg(running[0], signal.SIGTERM)
+        finally:
+            os._exit(128 + signum)
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    replies = os.fdopen(int(argv[1]), 'w')
+    _cloexec(replies.fileno())
+    del sys.path[0] # this file's directory, so flow's own modules do not shadow the scripties'
+    for m in argv[2:]:
+        try:
+            __import__(m)
+        except ImportError as e:
+            sys.stderr.write('WARNING: warm python worker could not preload %s: %s\n' % (m, e))
+
+    while True:
+        line = sys.stdin.readline()
+        if line == '':
+            break
+        request = json.loads(line)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                os.setpgid(0, 0)
+                replies.close()
+                status = _child(request)
+            finally:
+                os._exit(status)
+        try:
+            os.setpgid(pid, pid) # as well, so the group exists before flow hears of it
+        except OSError as e: # the child got there first
+            pass
+        running[0] = pid
+        if not _reply(replies, { 'pid': pid }):
+            os.killpg(pid, signal.SIGTERM)
+        (pid, status, usage) = _wait(pid)
+        running[0] = None
+        if not _reply(replies, { 'status': -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status),
+                                 'utime': usage.ru_utime, 'stime': usage.ru_stime, 'maxrss': usage.ru_maxrss }):
+            break
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,238 @@
+'''
+Watch mode: re-runs the directory flows whose files change, along with their ancestors
+'''
+import ctypes
+import ctypes.util
+import errno
+import os
+import os.path
+import select
+import stat
+import struct
+import sys
+import time
+
+from flow import _cancelled
+
+# from <sys/inotify.h>
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+_mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+_header = struct.Struct('iIII') # wd, mask, cookie, len
+
+def _ignored(name):
+    '''flow's own state files, hidden files and editor backups'''
+    return name.startswith('.') or name.endswith('~')
+
+class _Inotify(object):
+    '''watches directories with Linux inotify, through ctypes'''
+    def __init__(self, root):
+        super(_Inotify, self).__init__()
+        self._root = root
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self._fd = self._libc.inotify_init()
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init failed')
+        self._wds = dict() # watch descriptor to directory relative to root
+        self._rels = dict()
+
+    def add(self, rel):
+        wd = self._libc.inotify_add_watch(self._fd, os.path.join(self._root, rel), _mask)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e in (errno.ENOENT, errno.ENOTDIR): # gone already
+                return
+            raise OSError(e, 'inotify_add_watch failed for %s (see /proc/sys/fs/inotify/max_user_watches)' % (rel))
+        self._wds[wd] = rel
+        self._rels[rel] = wd
+
+    def remove(self, rel):
+        wd = self._rels.pop(rel, None)
+        if wd is not None:
+            del self._wds[wd]
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    def events(self, timeout):
+        '''returns [(directory, name, isdir, kind)] within `timeout` seconds, where kind is 'created', 'deleted',
+        'changed' or 'overflow' (when the kernel dropped events)'''
+        if len(select.select([self._fd], [], [], timeout)[0]) == 0:
+            return []
+        data = os.read(self._fd, 65536)
+        results = list()
+        i = 0
+        while i < len(data):
+            (wd, mask, cookie, n) = _header.unpack_from(data, i)
+            name = data[i + _header.size:i + _header.size + n].rstrip('\0')
+            i += _header.size + n
+            if mask & IN_Q_OVERFLOW:
+                results.append(('', '', True, 'overflow'))
+            elif wd in self._wds:
+                kind = 'created' if mask & (IN_CREATE | IN_MOVED_TO) else 'deleted' if mask & (IN_DELETE | IN_MOVED_FROM) else 'changed'
+                results.append((self._wds[wd], name, bool(mask & IN_ISDIR), kind))
+        return results
+
+class _Poller(object):
+    '''watches directories by comparing the mtimes and sizes of their entries every `interval` seconds'''
+    def __init__(self, root, interval):
+        super(_Poller, self).__init__()
+        self._root = root
+        self._interval = interval
+        self._snapshots = dict()
+
+    def _snapshot(self, rel):
+        dirp = os.path.join(self._root, rel)
+        snapshot = dict()
+        try:
+            for name in os.listdir(dirp):
+                try:
+                    st = os.lstat(os.path.join(dirp, name))
+                    snapshot[name] = (st.st_mtime, st.st_size, stat.S_ISDIR(st.st_mode))
+                except OSError, e: # removed meanwhile
+                    pass
+        except OSError, e:
+            pass
+        return snapshot
+
+    def add(self, rel):
+        self._snapshots[rel] = self._snapshot(rel)
+
+    def remove(self, rel):
+        self._snapshots.pop(rel, None)
+
+    def events(self, timeout):
+        time.sleep(min(timeout, self._interval))
+        results = list()
+        for (rel, old) in self._snapshots.items():
+            new = self._snapshot(rel)
+            self._snapshots[rel] = new
+            for name in set(old) | set(new):
+                if name not in new:
+                    results.append((rel, name, old[name][2], 'deleted'))
+                elif name not in old:
+                    results.append((rel, name, new[name][2], 'created'))
+                elif old[name] != new[name] and not new[name][2]:
+                    results.append((rel, name, False, 'changed'))
+        return results
+
+class FlowWatcher(object):
+    '''Runs a flow, then runs it again for each directory whose files change, along with the directory's ancestors,
+    deepest first. It keeps the tree in memory and updates it as directories come and go, rather than rescanning.
+    Changes are collected until none arrive for a moment, and changes made while the flow runs (such as the
+    scripties' own outputs) are ignored. Uses inotify where available, or else polls.
+    Supports FLOW_WATCH_DEBOUNCE (default 0.5 seconds) and FLOW_WATCH_INTERVAL (default 1 second, when polling)
+    environment variables.'''
+    def __init__(self, flow, recursive = False, debounce = None, interval = None):
+        '''@param flow the Flow to run
+        @param recursive watches and runs the subdirectories too
+        '''
+        super(FlowWatcher, self).__init__()
+        self._flow = flow
+        self._root = flow.rootdir()
+        self._recursive = recursive
+        self._debounce = debounce if debounce is not None else float(os.getenv('FLOW_WATCH_DEBOUNCE', '0.5'))
+        interval = interval if interval is not None else float(os.getenv('FLOW_WATCH_INTERVAL', '1'))
+        try:
+            self._backend = _Inotify(self._root)
+        except (OSError, AttributeError), e: # not Linux
+            self._backend = _Poller(self._root, interval)
+        self._tree = set()
+        try:
+            self._scan('')
+        except OSError, e: # out of inotify watches
+            print >>sys.stderr, 'WARNING: %s; polling instead' % (e)
+            self._backend = _Poller(self._root, interval)
+            self._tree = set()
+            self._scan('')
+
+    def _scan(self, rel):
+        '''adds `rel` and, if recursive, the subdirectories below it to the tree'''
+        rels = [rel]
+        if self._recursive:
+            rels += [os.path.join(rel, p) for (depth, p) in self._flow._walk(os.path.join(self._root, rel))]
+        for r in rels:
+            self._tree.add(r)
+            self._backend.add(r)
+
+    def _forget(self, rel):
+        for r in [r for r in self._tree if r == rel or r.startswith(rel + os.sep)]:
+            self._tree.discard(r)
+            self._backend.remove(r)
+
+    def _included(self, rel, name):
+        return name in self._flow._listdir(os.path.join(self._root, rel))[0]
+
+    def _apply(self, events):
+        '''updates the tree for `events`, returning the directories whose files changed'''
+        changed = set()
+        for (rel, name, isdir, kind) in events:
+            if kind == 'overflow':
+                self._forget('')
+                self._scan('')
+                changed.update(self._tree)
+            elif isdir:
+                p = os.path.join(rel, name)
+                if kind == 'deleted' and p in self._tree:
+                    self._forget(p)
+                    changed.add(rel)
+                elif kind == 'created' and self._recursive and p not in self._tree and self._included(rel, name):
+                    self._scan(p)
+                    changed.update([rel] + [r for r in self._tree if r == p or r.startswith(p + os.sep)])
+            elif not _ignored(name):
+                changed.add(rel)
+        return set([rel for rel in changed if rel in self._tree])
+
+    def _wait(self):
+        '''blocks until files change, and then until they stop changing for `debounce` seconds'''
+        changed = set()
+        while len(changed) == 0:
+            changed = self._apply(self._backend.events(3600.0))
+        while True:
+            events = self._backend.events(self._debounce)
+            if len(events) == 0:
+                return changed
+            changed.update(self._apply(events))
+
+    def _drain(self):
+        '''discards the changes that are already queued, e.g., the run's own, until there are none left, since each
+        read returns at most one buffer of events'''
+        while True:
+            events = self._backend.events(0)
+            if len(events) == 0:
+                return
+            self._apply(events)
+
+    def _run(self, dirs, style):
+        '''runs the flows for `dirs` and their ancestors, deepest first'''
+        todo = set()
+        for rel in dirs:
+            while rel != '':
+                todo.add(rel)
+                rel = os.path.dirname(rel)
+            todo.add('')
+        _cancelled.clear() # after a failure with -K
+        for rel in sorted(todo, key=lambda rel: (-len(rel.split(os.sep)) if rel != '' else 0, rel)):
+            try:
+                self._flow.spawn(os.path.join(self._root, rel) if rel != '' else self._root).run(0, 1, style)
+            except Exception, e: # keep watching, as the next edit may fix it
+                print >>sys.stderr, 'ERROR: %s' % (e)
+                break
+
+    def watch(self, depth = 0, nproc = 1, style = None, pool = None):
+        '''Runs the flow as Flow.run does, then watches it until interrupted'''
+        try:
+            self._flow.run(depth, nproc, style, pool)
+        except Exception, e:
+            print >>sys.stderr, 'ERROR: %s' % (e)
+        self._drain() # the run's own changes
+        while True:
+            print >>sys.stderr, 'Watching %d directories for changes' % (len(self._tree))
+            changed = self._wait()
+            self._run(changed, style)
+            self._drain()
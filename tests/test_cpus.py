@@ -0,0 +1,44 @@
+'''
+Tests of FlowCPUs, run with `python -m unittest discover tests`
+'''
+import multiprocessing as mp
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+import flow
+
+_cpus = None # inherited by the forked workers, as FlowPool passes its prototype
+
+def _init(cpus):
+    global _cpus
+    _cpus = cpus
+
+def _pinned(i):
+    with _cpus.pinned() as cpus:
+        time.sleep(0.2) # so that each worker takes some of the tasks
+        return (os.getpid(), tuple(cpus or ()))
+
+class FlowCPUsTest(unittest.TestCase):
+    def test_process_workers_pin_to_disjoint_cpus(self):
+        cpus = flow.FlowCPUs(2, threads={ None: 2 }, pin=True)
+        cpus._cpus = range(8) # as if on an 8 CPU node
+        cpus._init_lock()
+        pool = mp.Pool(2, _init, (cpus,)) # forked, so the workers get the parent's FlowCPUs without pickling
+        try:
+            results = pool.map(_pinned, range(8), 1)
+        finally:
+            pool.close()
+            pool.join()
+        workers = dict()
+        for (pid, pinned) in results:
+            workers.setdefault(pid, set()).update(pinned)
+        self.assertEqual(len(workers), 2)
+        (a, b) = workers.values()
+        self.assertTrue(len(a) > 0 and len(b) > 0)
+        self.assertEqual(a & b, set())
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+'''
+Tests of FlowSQLSession, run with `python -m unittest discover tests`
+'''
+import os
+import shutil
+import signal
+import StringIO
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from flow.flow import FlowSQLSession
+
+class FlowSQLSessionTest(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._env = dict(os.environ)
+        os.environ['SQL_BATCH_INCLUDE'] = "cat '%s'" # sh as the interpreter, whose output is the script itself
+        os.environ['SQL_BATCH_ECHO'] = 'echo %s'
+        self._stdout = sys.stdout
+        sys.stdout = StringIO.StringIO()
+        signal.alarm(10) # rather than block forever on a missed marker
+
+    def tearDown(self):
+        signal.alarm(0)
+        sys.stdout = self._stdout
+        os.environ.clear()
+        os.environ.update(self._env)
+        shutil.rmtree(self._dir)
+
+    def _script(self, name, text):
+        fn = os.path.join(self._dir, name)
+        f = open(fn, 'w')
+        try:
+            f.write(text)
+        finally:
+            f.close()
+        return fn
+
+    def test_output_without_final_newline(self):
+        session = FlowSQLSession(['sh'], self._dir)
+        try:
+            self.assertEqual(session.run(self._script('a.sql', '1|a\n2|b')), 0)
+            self.assertEqual(session.run(self._script('b.sql', '3|c\n')), 0)
+        finally:
+            session.close()
+        self.assertEqual(sys.stdout.getvalue(), '1|a\n2|b3|c\n')
+
+if __name__ == '__main__':
+    unittest.main()